@@ -1,28 +1,134 @@
 import asyncio
+import base64
+import contextlib
 import os
+import time
 from typing import Tuple, Optional
 from . import SendTgbot
 import httpx
 import aiomysql
 from . import db
+from . import bloom
+from . import tracing
 from datetime import datetime, timedelta
 import redis.asyncio as redis
 import uuid
+import collections
+import heapq
+import random
+import struct
+
+class _CountedStream(httpx.AsyncByteStream):
+    # response body that reports when it's closed (download pool accounting); iterates the inner stream directly
+    def __init__(self, stream: httpx.AsyncByteStream, on_close):
+        self._stream = stream
+        self._on_close = on_close
+
+    def __aiter__(self):
+        return self._stream.__aiter__()
+
+    async def aclose(self):
+        if self._on_close:
+            self._on_close()
+            self._on_close = None
+        await self._stream.aclose()
 
 class Con:
     _sbots: list[SendTgbot.Tgbot]
     MIN_JITTER_VALUE = 1
     MAX_JITTER_VALUE = 5
+    TMP_DIR = "./tmp"
+    RECONCILE_INTERVAL = 3600 * 6
+    RECONCILE_GRACE = 600 # sec. younger files/rows may still be in flight
+    RECONCILE_BATCH = 500
+    RECONCILE_PAUSE = 0.2 # sec between batches
     # MAX_RETRY = 10 
     # TODO
     # (이거 넘으면 cnt = 999등으로 버리거나, 갱신 시간 늘리지 않도록)
     # 일단은 LEAST(POW(2, retry_count), 3000) 정도?
 
-    def __init__(self, sbots, db_queue: asyncio.Queue, http_client: httpx.AsyncClient):
+    # dispatcher: jobs buffered per bot, and how long a bot may be throttled before its inbox is moved.
+    # claims are always whole batches (Tgbot.batch_size) so the priority / lane split holds; the surplus waits in _ready
+    DISPATCH_DEPTH = 2
+    DISPATCH_IDLE = 5
+    STEAL_AFTER = 10.0
+    # inbox jobs get updated_at refreshed this often, so GC (state 10 > 10 min) doesn't reset them while queued
+    DISPATCH_TOUCH_INTERVAL = 120
+
+    # unknown uuid guard
+    NEG_TTL = 30
+    BLOOM_CAPACITY = 5_000_000
+    BLOOM_LOOKBACK = 86400 # sec. uuid7s younger than this bypass the filter
+    BLOOM_SYNC_INTERVAL = 60
+    BLOOM_BATCH = 10000
+
+    # hot set: tracked top-K, persisted to hot_files, re-resolved at startup
+    HOT_K = 1000
+    HOT_PERSIST_INTERVAL = 300
+    HOT_MAX_AGE_HOURS = 24
+    WARM_RATE = 20 # getFile calls / sec while warming
+    WARM_CONCURRENCY = 4
+
+    # multipart reads
+    PART_READ_AHEAD = 2
+    # per part being read: bytes buffered ahead of the reader (not the whole 20 MB part)
+    PART_BUFFER_BYTES = 2 * 1024 * 1024
+
+    # hedged reads: recent upstream ttfb samples -> p95 delay before asking a replica
+    HEDGE_WINDOW = 512
+    HEDGE_RECALC_EVERY = 64
+
+    # download pool stats are printed this often (when there was traffic)
+    DOWNLOAD_STATS_INTERVAL = 60
+
+    # L1 urls: small hashes {prefix}u:{slice}:{bucket} -> {uuid hex rest}{suffix}: "<bot_id>:<file_path>".
+    # bucket = last URL_BUCKET_HEX hex digits of the uuid (random part of uuid7); small hashes stay listpack-encoded.
+    # a url lives in its URL_SLICE slice + the next one (30..60 min, file_path is valid >= 1h)
+    URL_TTL = 3600
+    URL_SLICE = URL_TTL // 2
+    URL_BUCKET_HEX = 3
+
+    # local bot api server: files are read straight from its working dir
+    LOCAL_READ_SIZE = 1024 * 1024
+
+    def __init__(self, sbots, db_queue: asyncio.Queue, http_client: httpx.AsyncClient, hedge_min_delay: float = 0.3,
+                 api_url: str = "https://api.telegram.org", api_local: bool = False,
+                 download_client: httpx.AsyncClient | None = None, download_limit: int = 100, read_size: int = 256 * 1024,
+                 redis_url: str = "redis://redis:6379/0", redis_max_connections: int = 50, redis_prefix: str = "tgc:"):
         self._sbots = sbots
-        self._redis = redis.Redis(host='redis', port=6379, db=0, decode_responses=True)
+        self._api_url = api_url.rstrip('/')
+        self._api_local = api_local
+        # blocking pool: a burst waits for a connection instead of failing
+        self._redis = redis.Redis(connection_pool=redis.BlockingConnectionPool.from_url(
+            redis_url, max_connections=redis_max_connections, timeout=5, decode_responses=True
+        ))
+        self._prefix = redis_prefix
+        # bot_id <-> token, so cached urls can be stored as bot_id + file_path
+        self._tokens: dict[int, str] = {b._bot_id: b._token for b in sbots}
+        self._token_ids: dict[str, int] = {t: i for i, t in self._tokens.items()}
         self._db_queue = db_queue
+        # getFile goes through http_client; file bodies through their own pool so big downloads can't starve it
         self._http_client = http_client
+        self._download_client = download_client or http_client
+        self._download_limit = download_limit
+        self.read_size = read_size
+        self._dl_active = 0
+        self._dl_peak = 0
+        self._dl_opened = 0
+        self._dl_saturated = 0
+        self._dl_pool_timeouts = 0
+        self._hedge_min_delay = hedge_min_delay
+        self._ttfb = collections.deque(maxlen=self.HEDGE_WINDOW)
+        self._ttfb_p95 = 0.0
+        self._dispatch_wakeup = asyncio.Event()
+        # claimed (state 10), not yet in an inbox; handed out in claim order
+        self._ready: collections.deque[dict] = collections.deque()
+        self._bloom = bloom.BloomFilter(self.BLOOM_CAPACITY)
+        self._bloom_ready = False
+        self._hits: dict[str, int] = {}
+        for b in sbots:
+            b.on_indexed = self.mark_indexed
+            b.on_job_done = self._on_job_done
 
     async def task(self):
         # enum state descriptions
@@ -32,6 +138,7 @@ class Con:
         # state = 30: Upload successfully & file_id, msg_id, etc recorded to queues
         # state = 40: Inserted to files table & deleted tmp
         # state = 100: error
+        # state = 110: lost (tmp file gone before it was indexed); kept for inspection, never retried
         while True:
             try:
                 if db.pool:
@@ -41,6 +148,7 @@ class Con:
                             async with conn.cursor(aiomysql.DictCursor) as cursor:
                                 # Init cnt
                                 cnt_10, cnt_20, cnt_30, cnt_40, cnt_100 = 0, 0, 0, 0, 0
+                                redone = []
 
                                 # 1: UNDO STATE 10 | 20 > 10min w/ Jitter
                                 await cursor.execute("SELECT file_uuid, state FROM queues WHERE state IN (10, 20) AND updated_at < NOW() - INTERVAL 10 MINUTE")
@@ -77,9 +185,14 @@ class Con:
                                     for job in stale_redo_jobs:  # fix
                                         file_uuid_bytes, file_uuid_str = job['file_uuid'], str(uuid.UUID(bytes=job['file_uuid']))
                                         try:
-                                            await cursor.execute("INSERT INTO files (file_uuid, file_id, msg_id, bot_id) VALUES (%s, %s, %s, %s)",
-                                                                 (file_uuid_bytes, job['file_id'], job['msg_id'], job['bot_id']))
+                                            await cursor.execute(
+                                                """
+                                                INSERT INTO files (file_uuid, file_id, msg_id, bot_id, chat_id, part_count, file_size, mime_type, sha256, width, height)
+                                                SELECT file_uuid, file_id, msg_id, bot_id, chat_id, part_count, file_size, mime_type, sha256, width, height
+                                                FROM queues WHERE file_uuid = %s
+                                                """, (file_uuid_bytes,))
                                             await cursor.execute("UPDATE queues SET state = 40, updated_at = NOW() WHERE file_uuid = %s AND state = 30", (file_uuid_bytes,))
+                                            redone.append(file_uuid_bytes)
                                         except Exception as e:
                                             print(f"[Controller GC] Error re-committing job {file_uuid_str}: {e}")
                                 
@@ -121,6 +234,8 @@ class Con:
                                     print(f"[Controller GC] Logged GC run summary.")
                             
                             await conn.commit()
+                            for file_uuid_bytes in redone:
+                                await self.mark_indexed(file_uuid_bytes)
 
                         except Exception as e:
                             await conn.rollback()
@@ -131,12 +246,421 @@ class Con:
             # GC sleeps an hour
             await asyncio.sleep(3600)
 
-    # redis?
+    def notify_enqueued(self):
+        # new queue row -> let the dispatcher claim now instead of after DISPATCH_IDLE
+        self._dispatch_wakeup.set()
+
+    def _on_job_done(self, bot: SendTgbot.Tgbot):
+        # inbox has room again -> refill now instead of after DISPATCH_IDLE
+        if bot.backlog < self.DISPATCH_DEPTH:
+            self._dispatch_wakeup.set()
+
+    def _pending_uuids(self) -> list[bytes]:
+        # claimed by this process but not started: inboxes + _ready
+        return [job['file_uuid'] for b in self._sbots for job in b.inbox] + [job['file_uuid'] for job in self._ready]
+
+    def _pick_bot(self, exclude: SendTgbot.Tgbot | None = None) -> SendTgbot.Tgbot | None:
+        # lowest expected_wait among bots that aren't long-throttled. None if there is none
+        candidates = [b for b in self._sbots if b is not exclude and b.throttled_for() <= self.STEAL_AFTER]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda b: b.expected_wait())
+
+    def _rebalance(self):
+        # hand the inbox of a long-throttled bot to whoever would finish it sooner
+        for bot in self._sbots:
+            if bot.inbox and bot.throttled_for() > self.STEAL_AFTER:
+                jobs = list(bot.inbox)
+                moved = 0
+                for job in jobs:
+                    target = self._pick_bot(exclude=bot)
+                    if target is None:
+                        break # everyone is throttled -> leave the rest where they are
+                    bot.inbox.remove(job)
+                    target.assign(job)
+                    moved += 1
+                if moved:
+                    print(f"[Controller Dispatch] Moved {moved} jobs off throttled sbot[{bot._bot_id}].")
+
+    async def _touch_pending(self):
+        uuids = self._pending_uuids()
+        if not uuids or not db.pool:
+            return
+        placeholders = ', '.join(['%s'] * len(uuids))
+        async with db.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    f"UPDATE queues SET updated_at = NOW() WHERE file_uuid IN ({placeholders}) AND state = 10",
+                    tuple(uuids)
+                )
+                await conn.commit()
+
+    async def dispatch_task(self):
+        """
+        central claim loop: keep every usable bot's inbox DISPATCH_DEPTH deep and
+        route each claimed job to the bot with the lowest expected_wait().
+        inboxes are fed from _ready, which is refilled a whole weighted batch at a time:
+        a 1-2 job claim would always be one interactive job from the oldest lane (plain FIFO).
+        """
+        last_touch = time.monotonic()
+        while True:
+            # cleared before looking, so a wakeup that lands mid-iteration (job done, upload) isn't lost
+            self._dispatch_wakeup.clear()
+            claimed = 0
+            try:
+                self._rebalance()
+                if time.monotonic() - last_touch > self.DISPATCH_TOUCH_INTERVAL:
+                    last_touch = time.monotonic()
+                    await self._touch_pending()
+                free = sum(
+                    max(0, self.DISPATCH_DEPTH - b.backlog)
+                    for b in self._sbots if b.throttled_for() <= self.STEAL_AFTER
+                )
+                if free and db.pool:
+                    if len(self._ready) < free:
+                        batch = max(self._sbots[0].batch_size, free - len(self._ready))
+                        self._ready.extend(await self._sbots[0]._fetch_and_claim_jobs(limit=batch))
+                    claimed = min(free, len(self._ready))
+                    for _ in range(claimed):
+                        job = self._ready.popleft()
+                        (self._pick_bot() or min(self._sbots, key=lambda b: b.expected_wait())).assign(job)
+            except Exception as e:
+                print(f"[Controller Dispatch] Error in task loop: {e}")
+
+            if claimed:
+                # re-check: a throttled bot may have come back meanwhile
+                continue
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._dispatch_wakeup.wait(), timeout=self.DISPATCH_IDLE)
+
+    async def release_pending(self):
+        # shutdown: jobs still sitting in inboxes / _ready go straight back to state 0 (no 10 min GC wait)
+        uuids = self._pending_uuids()
+        for b in self._sbots:
+            b.inbox.clear()
+        self._ready.clear()
+        if not uuids or not db.pool:
+            return
+        placeholders = ', '.join(['%s'] * len(uuids))
+        async with db.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    f"UPDATE queues SET state = 0, bot_id = NULL, updated_at = NOW() WHERE file_uuid IN ({placeholders}) AND state = 10",
+                    tuple(uuids)
+                )
+                await conn.commit()
+        print(f"[Controller Dispatch] Released {len(uuids)} undispatched jobs.")
+
+    async def _load_uuids_after(self, last: bytes) -> bytes:
+        # keyset scan of files.file_uuid into the filter
+        while True:
+            async with db.pool.acquire() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute(
+                        "SELECT file_uuid FROM files WHERE file_uuid > %s ORDER BY file_uuid LIMIT %s",
+                        (last, self.BLOOM_BATCH)
+                    )
+                    rows = await cursor.fetchall()
+            for (file_uuid,) in rows:
+                self._bloom.add(file_uuid)
+            if len(rows) < self.BLOOM_BATCH:
+                return rows[-1][0] if rows else last
+            last = rows[-1][0]
+            await asyncio.sleep(0)
+
+    async def _load_uuids_since(self, since: datetime):
+        # keyset scan of files by (created_at, file_uuid) -> rows inserted since, whatever their uuid
+        last_ts, last_uuid = since, b''
+        while True:
+            async with db.pool.acquire() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute(
+                        """
+                        SELECT created_at, file_uuid FROM files
+                        WHERE created_at >= %s AND (created_at > %s OR file_uuid > %s)
+                        ORDER BY created_at, file_uuid
+                        LIMIT %s
+                        """,
+                        (last_ts, last_ts, last_uuid, self.BLOOM_BATCH)
+                    )
+                    rows = await cursor.fetchall()
+            for (_, file_uuid) in rows:
+                self._bloom.add(file_uuid)
+            if len(rows) < self.BLOOM_BATCH:
+                return
+            last_ts, last_uuid = rows[-1]
+            await asyncio.sleep(0)
+
+    async def _db_now(self) -> datetime:
+        async with db.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute("SELECT NOW()")
+                (now,) = await cursor.fetchone()
+        return now
+
+    async def bloom_task(self):
+        """
+        full load once, then every BLOOM_SYNC_INTERVAL the rows inserted since the last sync
+        (by files.created_at, so late rows with old uuids - gc redo, index_cli backfill - land too).
+        each sync overlaps the previous one by BLOOM_SYNC_INTERVAL for rows committed late.
+        """
+        since = None
+        while not self._bloom_ready:
+            try:
+                if db.pool:
+                    since = await self._db_now()
+                    async with db.pool.acquire() as conn:
+                        async with conn.cursor() as cursor:
+                            await cursor.execute("SELECT COUNT(*) FROM files")
+                            (count,) = await cursor.fetchone()
+                    if count * 2 > self._bloom.capacity:
+                        self._bloom = bloom.BloomFilter(count * 2)
+                    await self._load_uuids_after(b'')
+                    self._bloom_ready = True
+                    print(f"[Controller Bloom] Loaded {self._bloom.count} file uuids.")
+                    break
+            except Exception as e:
+                print(f"[Controller Bloom] Initial load failed: {e}")
+            await asyncio.sleep(5)
+
+        while True:
+            await asyncio.sleep(self.BLOOM_SYNC_INTERVAL)
+            try:
+                now = await self._db_now()
+                await self._load_uuids_since(since - timedelta(seconds=self.BLOOM_SYNC_INTERVAL))
+                since = now
+            except Exception as e:
+                print(f"[Controller Bloom] Sync failed: {e}")
+
+    async def persist_hot_task(self):
+        """
+        every HOT_PERSIST_INTERVAL: halve every row's hits, add the in-process top-K
+        (so the set follows traffic) and drop rows not seen for HOT_MAX_AGE_HOURS or decayed to 0.
+        updated_at = last time the file was in a batch, set explicitly (an ON UPDATE timestamp would
+        move on every decay, or freeze once a steady file's hits settle at a fixed point).
+        """
+        while True:
+            await asyncio.sleep(self.HOT_PERSIST_INTERVAL)
+            hits, self._hits = self._hits, {}
+            if not hits or not db.pool:
+                continue
+            rows = []
+            for file_uuid, count in heapq.nlargest(self.HOT_K, hits.items(), key=lambda kv: kv[1]):
+                file_uuid_obj = db.parse_uuid(file_uuid)
+                if file_uuid_obj:
+                    rows.append((file_uuid_obj.bytes, count))
+            try:
+                async with db.pool.acquire() as conn:
+                    async with conn.cursor() as cursor:
+                        await conn.begin()
+                        try:
+                            await cursor.execute("UPDATE hot_files SET hits = hits DIV 2")
+                            await cursor.executemany(
+                                """
+                                INSERT INTO hot_files (file_uuid, hits) VALUES (%s, %s)
+                                ON DUPLICATE KEY UPDATE hits = hits + VALUES(hits), updated_at = NOW()
+                                """,
+                                rows
+                            )
+                            await cursor.execute(
+                                f"DELETE FROM hot_files WHERE hits = 0 OR updated_at < NOW() - INTERVAL {self.HOT_MAX_AGE_HOURS} HOUR"
+                            )
+                            await conn.commit()
+                        except Exception:
+                            await conn.rollback()
+                            raise
+            except Exception as e:
+                print(f"[Controller Hot] Persist failed: {e}")
+
+    async def warm_task(self):
+        """
+        startup: re-resolve the persisted hot set into redis at WARM_RATE,
+        so a deploy doesn't turn into a burst of cold getFile calls.
+        """
+        if not db.pool:
+            return
+        try:
+            async with db.pool.acquire() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute(
+                        "SELECT file_uuid FROM hot_files ORDER BY hits DESC LIMIT %s",
+                        (self.HOT_K,)
+                    )
+                    rows = await cursor.fetchall()
+        except Exception as e:
+            print(f"[Controller Warm] Could not load hot set: {e}")
+            return
+
+        sem = asyncio.Semaphore(self.WARM_CONCURRENCY)
+        warmed = 0
+
+        async def _warm(file_uuid: str):
+            nonlocal warmed
+            async with sem:
+                try:
+                    # _get_cache: warming is not traffic, keep it out of the hit counts
+                    if await self._get_cache(file_uuid):
+                        warmed += 1
+                except Exception as e:
+                    print(f"[Controller Warm] {file_uuid}: {e}")
+
+        # redis may have survived the restart: one pipelined read, only resolve what's missing
+        uuids = [str(uuid.UUID(bytes=file_uuid)) for (file_uuid,) in rows]
+        slots = [self._url_slot(file_uuid) for file_uuid in uuids]
+        try:
+            async with self._redis.pipeline(transaction=False) as pipe:
+                self._queue_url_reads(pipe, slots)
+                cached = self._take_urls(await pipe.execute(), slots)
+        except Exception as e:
+            print(f"[Controller Warm] Could not check redis: {e}")
+            cached = [None] * len(uuids)
+        cold = [file_uuid for file_uuid, value in zip(uuids, cached) if not value]
+
+        tasks = []
+        for file_uuid in cold:
+            tasks.append(asyncio.create_task(_warm(file_uuid)))
+            await asyncio.sleep(1 / self.WARM_RATE)
+        await asyncio.gather(*tasks)
+        print(f"[Controller Warm] Warmed {warmed}/{len(cold)} hot files ({len(uuids) - len(cold)} already cached).")
+
+    async def close(self):
+        await self._redis.aclose()
+
+    async def reconcile_task(self):
+        # runs once at startup, then every RECONCILE_INTERVAL
+        while True:
+            try:
+                if db.pool:
+                    await self.reconcile_tmp()
+            except Exception as e:
+                print(f"[Controller Reconcile] Error in task loop: {e}")
+            await asyncio.sleep(self.RECONCILE_INTERVAL)
+
+    def _scan_tmp_batch(self, it) -> list[tuple[str, bytes]] | None:
+        # blocking part (readdir + stat), run in a thread. None when exhausted
+        batch = []
+        cutoff = time.time() - self.RECONCILE_GRACE
+        for entry in it:
+            try:
+                file_uuid = uuid.UUID(entry.name)
+                # still being written by /upload (or just enqueued)
+                if not entry.is_file() or entry.stat().st_mtime > cutoff:
+                    continue
+            except (ValueError, OSError):
+                continue
+            batch.append((entry.path, file_uuid.bytes))
+            if len(batch) >= self.RECONCILE_BATCH:
+                return batch
+        return batch or None
+
+    async def _existing_uuids(self, cursor, table: str, uuids: list[bytes], extra: str = "") -> set[bytes]:
+        placeholders = ', '.join(['%s'] * len(uuids))
+        await cursor.execute(f"SELECT file_uuid FROM {table} WHERE file_uuid IN ({placeholders}) {extra}", tuple(uuids))
+        return {row['file_uuid'] for row in await cursor.fetchall()}
+
+    async def reconcile_tmp(self):
+        """
+        1: tmp files w/o a pending queue row (already indexed, or the enqueue never happened) -> delete
+        2: pending queue rows whose tmp file is gone -> close out (state 40) if indexed,
+           else mark lost (state 110): the client was already told the upload succeeded
+        batched IN queries, throttled by RECONCILE_PAUSE so the event loop stays free.
+        """
+        cnt_files, cnt_rows = 0, 0
+
+        # 1: ./tmp -> db
+        if os.path.isdir(self.TMP_DIR):
+            it = os.scandir(self.TMP_DIR)
+            try:
+                while True:
+                    batch = await asyncio.to_thread(self._scan_tmp_batch, it)
+                    if not batch:
+                        break
+                    uuids = [b for _, b in batch]
+                    async with db.pool.acquire() as conn:
+                        async with conn.cursor(aiomysql.DictCursor) as cursor:
+                            pending = await self._existing_uuids(cursor, "queues", uuids, "AND state <> 40")
+                    # indexed, but a bot is still sending replicas from the tmp file
+                    replicating = set().union(*(b.replicating for b in self._sbots))
+                    orphans = [path for path, b in batch if b not in pending and b not in replicating]
+                    if orphans:
+                        cnt_files += await asyncio.to_thread(self._remove_files, orphans)
+                    await asyncio.sleep(self.RECONCILE_PAUSE)
+            finally:
+                it.close()
+
+        # 2: db -> ./tmp (keyset over file_uuid)
+        last = b''
+        while True:
+            async with db.pool.acquire() as conn:
+                async with conn.cursor(aiomysql.DictCursor) as cursor:
+                    await cursor.execute(
+                        """
+                        SELECT file_uuid
+                        FROM queues
+                        WHERE state IN (0, 100) AND file_uuid > %s AND created_at < NOW() - INTERVAL %s SECOND
+                        ORDER BY file_uuid
+                        LIMIT %s
+                        """,
+                        (last, self.RECONCILE_GRACE, self.RECONCILE_BATCH)
+                    )
+                    rows = await cursor.fetchall()
+                    if not rows:
+                        break
+                    last = rows[-1]['file_uuid']
+                    uuids = [row['file_uuid'] for row in rows]
+                    missing = await asyncio.to_thread(
+                        lambda: [b for b in uuids if not os.path.exists(os.path.join(self.TMP_DIR, str(uuid.UUID(bytes=b))))]
+                    )
+                    if missing:
+                        indexed = await self._existing_uuids(cursor, "files", missing)
+                        lost = [b for b in missing if b not in indexed]
+                        await conn.begin()
+                        try:
+                            if indexed:
+                                placeholders = ', '.join(['%s'] * len(indexed))
+                                await cursor.execute(
+                                    f"UPDATE queues SET state = 40, updated_at = NOW() WHERE file_uuid IN ({placeholders}) AND state IN (0, 100)",
+                                    tuple(indexed))
+                            if lost:
+                                placeholders = ', '.join(['%s'] * len(lost))
+                                await cursor.execute(
+                                    f"UPDATE queues SET state = 110, updated_at = NOW() WHERE file_uuid IN ({placeholders}) AND state IN (0, 100)",
+                                    tuple(lost))
+                                for b in lost:
+                                    print(f"[Controller Reconcile] Lost upload {uuid.UUID(bytes=b)}: tmp file gone, never indexed (state 110).")
+                            await conn.commit()
+                        except Exception:
+                            await conn.rollback()
+                            raise
+                        cnt_rows += len(missing)
+            await asyncio.sleep(self.RECONCILE_PAUSE)
+
+        if cnt_files or cnt_rows:
+            print(f"[Controller Reconcile] Removed {cnt_files} orphaned tmp files, resolved {cnt_rows} queue rows.")
+
+    def _remove_files(self, paths: list[str]) -> int:
+        removed = 0
+        for path in paths:
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError as e:
+                print(f"[Controller Reconcile] Error deleting temp file {path}: {e}")
+        return removed
+
+    def _remember_token(self, bot_id: int, bot_token: str):
+        self._tokens[bot_id] = bot_token
+        self._token_ids[bot_token] = bot_id
+
     async def _get_token(self, bot_id: int) -> str | None:
-        # L1...?
-        bot_token = await self._redis.get(str(bot_id))
+        # process memory -> redis hash (tokens never change) -> bots
+        bot_token = self._tokens.get(bot_id)
         if bot_token:
             return bot_token
+        bot_token = await self._redis.hget(f"{self._prefix}tokens", str(bot_id))
+        if bot_token:
+            self._remember_token(bot_id, bot_token)
+            return bot_token
 
         if not db.pool:
             raise RuntimeError("Database pool is not initialized.")
@@ -154,60 +678,583 @@ class Con:
                 result = await cursor.fetchone()
                 bot_token = result['bot_token'] if result else None
                 if(bot_token):
-                    await self._redis.setex(str(bot_id), 999999999, bot_token)
+                    await self._redis.hset(f"{self._prefix}tokens", str(bot_id), bot_token)
+                    self._remember_token(bot_id, bot_token)
                     return bot_token
                 return None
 
-    async def get_cache(self, file_uuid: str) -> str | None:
-        # L1: redis
-        telegram_file_url = await self._redis.get(file_uuid)
-        if telegram_file_url:
-            return telegram_file_url
+    def _url_slot(self, file_uuid: str, suffix: str = '') -> tuple[str, str]:
+        # -> (bucket, field)
+        h = file_uuid.replace('-', '')
+        return h[-self.URL_BUCKET_HEX:], h[:-self.URL_BUCKET_HEX] + suffix
+
+    def _url_key(self, slice_no: int, bucket: str) -> str:
+        return f"{self._prefix}u:{slice_no}:{bucket}"
+
+    def _compact_url(self, url: str) -> str:
+        # https://.../file/bot<token>/<file_path> -> "<bot_id>:<file_path>" (unknown bots / local paths stay as is)
+        head = f"{self._api_url}/file/bot"
+        if url.startswith(head):
+            token, _, file_path = url[len(head):].partition('/')
+            bot_id = self._token_ids.get(token)
+            if bot_id is not None:
+                return f"{bot_id}:{file_path}"
+        return url
+
+    async def _expand_url(self, value: str) -> str | None:
+        if not value[0].isdigit():
+            return value
+        bot_id, _, file_path = value.partition(':')
+        bot_token = await self._get_token(int(bot_id))
+        if not bot_token:
+            return None
+        return f"{self._api_url}/file/bot{bot_token}/{file_path}"
+
+    def _queue_url_reads(self, pipe, slots: list[tuple[str, str]]):
+        # current + previous slice, HMGET per bucket -> read back with _take_urls
+        now = int(time.time()) // self.URL_SLICE
+        for bucket, fields in self._group_slots(slots).items():
+            for slice_no in (now, now - 1):
+                pipe.hmget(self._url_key(slice_no, bucket), fields)
+
+    def _take_urls(self, results: list, slots: list[tuple[str, str]]) -> list[str | None]:
+        # compact values in slots order; newer slice wins
+        found = {}
+        it = iter(results)
+        for bucket, fields in self._group_slots(slots).items():
+            current, previous = next(it), next(it)
+            for field, a, b in zip(fields, current, previous):
+                found[(bucket, field)] = a or b
+        return [found[slot] for slot in slots]
+
+    @staticmethod
+    def _group_slots(slots: list[tuple[str, str]]) -> dict[str, list[str]]:
+        grouped: dict[str, list[str]] = {}
+        for bucket, field in slots:
+            if field not in grouped.setdefault(bucket, []):
+                grouped[bucket].append(field)
+        return grouped
+
+    async def _get_urls(self, slots: list[tuple[str, str]]) -> list[str | None]:
+        """ cached urls for (bucket, field) slots, one round trip """
+        async with self._redis.pipeline(transaction=False) as pipe:
+            self._queue_url_reads(pipe, slots)
+            results = await pipe.execute()
+        return [v and await self._expand_url(v) for v in self._take_urls(results, slots)]
+
+    def _queue_url_writes(self, pipe, entries: list[tuple[str, str, str]]):
+        # [(bucket, field, url)] into the current slice
+        slice_no = int(time.time()) // self.URL_SLICE
+        for bucket, field, url in entries:
+            key = self._url_key(slice_no, bucket)
+            pipe.hset(key, field, self._compact_url(url))
+            pipe.expireat(key, (slice_no + 2) * self.URL_SLICE)
+
+    async def _set_urls(self, entries: list[tuple[str, str, str]]):
+        async with self._redis.pipeline(transaction=False) as pipe:
+            self._queue_url_writes(pipe, entries)
+            await pipe.execute()
+
+    # L1 metadata: same buckets / fields as the urls, in {prefix}m:{slice}:{bucket} with daily slices
+    # (immutable once indexed, so it outlives the url; a value lives 1..2 days).
+    # value = base64 of META_STRUCT (size, width, height, parts, mime code, raw sha256) = 64 chars,
+    # so buckets stay listpack-encoded; a mime w/o a code is appended as is.
+    META_SLICE = 86400
+    META_STRUCT = struct.Struct('>IIIHB32s')
+    META_B64_LEN = -(-META_STRUCT.size // 3) * 4
+    MIME_CODES = (None, 'image/jpeg', 'image/png', 'image/gif', 'image/webp', 'image/bmp', 'application/octet-stream')
+    _MIME_RAW = 0xff
+    _SIZE_UNKNOWN = 0xffffffff
+
+    @classmethod
+    def _pack_meta(cls, meta: dict) -> str:
+        mime = meta.get('mime')
+        code = cls.MIME_CODES.index(mime) if mime in cls.MIME_CODES else cls._MIME_RAW
+        size = meta.get('size')
+        packed = cls.META_STRUCT.pack(
+            cls._SIZE_UNKNOWN if size is None else size,
+            meta.get('width') or 0,
+            meta.get('height') or 0,
+            meta.get('parts') or 1,
+            code,
+            bytes.fromhex(meta['sha256']) if meta.get('sha256') else bytes(32),
+        )
+        value = base64.b64encode(packed).decode()
+        return value + mime if code == cls._MIME_RAW else value
+
+    @classmethod
+    def _unpack_meta(cls, value: str | None) -> dict | None:
+        # inverse of _pack_meta; unknown fields (legacy rows) come back as None
+        if not value:
+            return None
+        size, width, height, parts, code, sha256 = cls.META_STRUCT.unpack(base64.b64decode(value[:cls.META_B64_LEN]))
+        if code == cls._MIME_RAW:
+            mime = value[cls.META_B64_LEN:]
+        else:
+            mime = cls.MIME_CODES[code] if code < len(cls.MIME_CODES) else None
+        return {
+            'size': None if size == cls._SIZE_UNKNOWN else size,
+            'mime': mime,
+            'sha256': sha256.hex() if any(sha256) else None,
+            'width': width or None,
+            'height': height or None,
+            'parts': parts or 1,
+        }
+
+    def _meta_key(self, slice_no: int, bucket: str) -> str:
+        return f"{self._prefix}m:{slice_no}:{bucket}"
+
+    def _queue_meta_read(self, pipe, slot: tuple[str, str]):
+        # current + previous slice -> read back with _take_meta
+        bucket, field = slot
+        now = int(time.time()) // self.META_SLICE
+        for slice_no in (now, now - 1):
+            pipe.hget(self._meta_key(slice_no, bucket), field)
+
+    def _take_meta(self, current: str | None, previous: str | None) -> dict | None:
+        return self._unpack_meta(current or previous)
+
+    def _queue_meta_write(self, pipe, slot: tuple[str, str], meta: dict):
+        bucket, field = slot
+        slice_no = int(time.time()) // self.META_SLICE
+        key = self._meta_key(slice_no, bucket)
+        pipe.hset(key, field, self._pack_meta(meta))
+        pipe.expireat(key, (slice_no + 2) * self.META_SLICE)
+
+    async def _set_meta(self, slot: tuple[str, str], meta: dict):
+        async with self._redis.pipeline(transaction=False) as pipe:
+            self._queue_meta_write(pipe, slot, meta)
+            await pipe.execute()
+
+    async def _set_l1(self, slot: tuple[str, str], url: str, meta: dict):
+        # url + metadata in one round trip
+        async with self._redis.pipeline(transaction=False) as pipe:
+            self._queue_url_writes(pipe, [(*slot, url)])
+            self._queue_meta_write(pipe, slot, meta)
+            await pipe.execute()
+
+    def _neg_key(self, file_uuid: str) -> str:
+        return f"{self._prefix}n:{file_uuid}"
+
+    def _screen(self, file_uuid: str) -> uuid.UUID | None:
+        """
+        L0: malformed -> None. uuids older than BLOOM_LOOKBACK that the bloom filter
+        has never seen -> None. anything else may exist and goes on to the cache tiers.
+        """
+        file_uuid_obj = db.parse_uuid(file_uuid)
+        if file_uuid_obj is None:
+            return None
+        if not self._bloom_ready:
+            return file_uuid_obj
+        # recent uuid7s may still be queued / indexed by another path -> don't trust the filter
+        if file_uuid_obj.bytes >= db.uuid7_floor(time.time_ns() - self.BLOOM_LOOKBACK * 1_000_000_000):
+            return file_uuid_obj
+        if file_uuid_obj.bytes not in self._bloom:
+            return None
+        return file_uuid_obj
+
+    async def _remember_miss(self, file_uuid: str):
+        await self._redis.setex(self._neg_key(file_uuid), self.NEG_TTL, 1)
+
+    async def mark_indexed(self, file_uuid: bytes):
+        # called once a files row is committed (worker / gc redo)
+        self._bloom.add(file_uuid)
+        await self._redis.delete(self._neg_key(str(uuid.UUID(bytes=file_uuid))))
+
+    async def get_meta(self, file_uuid: str) -> dict | None:
+        """
+        size / mime / sha256 / width / height of an indexed file, w/o touching telegram.
+        None if the uuid is not in the index.
+        """
+        file_uuid_obj = self._screen(file_uuid)
+        if file_uuid_obj is None:
+            return None
+        file_uuid = str(file_uuid_obj)
+        slot = self._url_slot(file_uuid)
+
+        async with self._redis.pipeline(transaction=False) as pipe:
+            self._queue_meta_read(pipe, slot)
+            pipe.exists(self._neg_key(file_uuid))
+            *meta_results, negative = await pipe.execute()
+        meta = self._take_meta(*meta_results)
+        if meta:
+            return meta
+        if negative:
+            return None
+
+        files_repo = db.FilesRepository()
+        with tracing.span("L3_files"):
+            file_result = await files_repo.get_file_by_uuid(file_uuid_obj)
+        if not file_result:
+            await self._remember_miss(file_uuid)
+            return None
+        meta = db.row_to_meta(file_result)
+        await self._set_meta(slot, meta)
+        return meta
+
+    def _record_hit(self, file_uuid: str):
+        # lossy top-K: prune to the K largest once the table doubles (amortized O(1))
+        self._hits[file_uuid] = self._hits.get(file_uuid, 0) + 1
+        if len(self._hits) > self.HOT_K * 2:
+            self._hits = dict(heapq.nlargest(self.HOT_K, self._hits.items(), key=lambda kv: kv[1]))
+
+    async def get_cache(self, file_uuid: str) -> Optional[Tuple[str, dict]]:
+        result = await self._get_cache(file_uuid)
+        if result:
+            self._record_hit(file_uuid)
+        return result
+
+    async def _get_cache(self, file_uuid: str) -> Optional[Tuple[str, dict]]:
+        # L0: malformed / bloom filter
+        file_uuid_obj = self._screen(file_uuid)
+        if file_uuid_obj is None:
+            return None
+        file_uuid = str(file_uuid_obj)
+
+        # L1: redis (+ negative cache)
+        slot = self._url_slot(file_uuid)
+        with tracing.span("L1_redis"):
+            async with self._redis.pipeline(transaction=False) as pipe:
+                self._queue_url_reads(pipe, [slot])
+                self._queue_meta_read(pipe, slot)
+                pipe.exists(self._neg_key(file_uuid))
+                *url_results, meta_current, meta_previous, negative = await pipe.execute()
+            cached_url = self._take_urls(url_results, [slot])[0]
+            telegram_file_url = cached_url and await self._expand_url(cached_url)
+        meta = self._take_meta(meta_current, meta_previous)
+        if telegram_file_url and meta:
+            return telegram_file_url, meta
+        if negative:
+            return None
         
         # L2: url_caches
         url_cache_repo = db.UrlCacheRepository()
-        url_cache_result = await url_cache_repo.get_url_cache_by_uuid(file_uuid)
+        with tracing.span("L2_url_caches"):
+            url_cache_result = await url_cache_repo.get_url_cache_by_uuid(file_uuid_obj)
         
         if url_cache_result:
-            telegram_file_url = await self._get_telegram_file_url(
+            meta = db.row_to_meta(url_cache_result)
+            telegram_file_url = telegram_file_url or await self._resolve_with_fallback(
+                file_uuid,
                 url_cache_result["bot_token"],
                 url_cache_result['file_id']
             )
 
             # generate L1
-            await self._redis.setex(file_uuid, 3600, telegram_file_url)
-            return telegram_file_url
+            await self._set_l1(slot, telegram_file_url, meta)
+            return telegram_file_url, meta
                 
         # L3: files, etc
         files_repo = db.FilesRepository()
-        file_result = await files_repo.get_file_by_uuid(file_uuid)
+        with tracing.span("L3_files"):
+            file_result = await files_repo.get_file_by_uuid(file_uuid_obj)
         if file_result:
+            meta = db.row_to_meta(file_result)
             bot_id = int(file_result['bot_id'])
             file_id = file_result['file_id']
-            bot_token = await self._get_token(bot_id)
-            if not bot_token: return None
+            with tracing.span("get_token", bot_id=bot_id):
+                bot_token = await self._get_token(bot_id)
             
             # generate L1
-            telegram_file_url = await self._get_telegram_file_url(bot_token, file_id)
-            await self._redis.setex(file_uuid, 3600, telegram_file_url)
+            telegram_file_url = await self._resolve_with_fallback(file_uuid, bot_token, file_id)
+            if not telegram_file_url: return None
+            await self._set_l1(slot, telegram_file_url, meta)
             
             # generate L2
             # stateless -> stateless (lockfree)
+            if not bot_token:
+                return telegram_file_url, meta
             db_task = {
                 "query": "INSERT IGNORE INTO url_caches (file_uuid, file_id, bot_token) VALUES (%s, %s, %s)",
-                "params": (uuid.UUID(file_uuid).bytes, file_id, bot_token)
+                "params": (file_uuid_obj.bytes, file_id, bot_token),
+                "enqueued_ns": time.time_ns()
             }
             try:
                 self._db_queue.put_nowait(db_task) # offload
             except asyncio.QueueFull:
                 pass # ignore(anyway ensure redis cache)
-            return telegram_file_url
+            return telegram_file_url, meta
+        await self._remember_miss(file_uuid)
         return None
 
+    async def get_parts(self, file_uuid: str) -> list[dict] | None:
+        """ [{offset, size, url}] of a multipart file in order. None if unknown / incomplete """
+        try:
+            file_uuid_bytes = uuid.UUID(file_uuid).bytes
+        except ValueError:
+            return None
+        async with db.pool.acquire() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cursor:
+                await cursor.execute(
+                    """
+                    SELECT p.part_no, p.part_offset, p.part_size, p.file_id, b.bot_token
+                    FROM parts p JOIN bots b ON b.bot_id = p.bot_id
+                    WHERE p.file_uuid = %s
+                    ORDER BY p.part_no
+                    """,
+                    (file_uuid_bytes,)
+                )
+                rows = await cursor.fetchall()
+        if not rows:
+            return None
+
+        slots = [self._url_slot(file_uuid, f"p{row['part_no']}") for row in rows]
+        urls = await self._get_urls(slots)
+        missing = [i for i, url in enumerate(urls) if not url]
+        if missing:
+            resolved = await asyncio.gather(
+                *(self._get_telegram_file_url(rows[i]['bot_token'], rows[i]['file_id']) for i in missing)
+            )
+            for i, url in zip(missing, resolved):
+                urls[i] = url
+            await self._set_urls([(*slots[i], url) for i, url in zip(missing, resolved)])
+
+        return [
+            {'offset': row['part_offset'], 'size': row['part_size'], 'url': url}
+            for row, url in zip(rows, urls)
+        ]
+
+    @staticmethod
+    def is_local(url: str) -> bool:
+        # --local bot api server hands out filesystem paths instead of urls
+        return url.startswith('/')
+
+    @staticmethod
+    def _read_range(path: str, offset: int, length: int) -> bytes:
+        with open(path, "rb") as f:
+            f.seek(offset)
+            return f.read(length)
+
+    async def _fetch_part(self, part: dict, lo: int, hi: int, out: asyncio.Queue):
+        # bytes [lo, hi] of one part -> out, then None (or the exception)
+        try:
+            if self.is_local(part['url']):
+                while lo <= hi:
+                    chunk = await asyncio.to_thread(self._read_range, part['url'], lo, min(self.LOCAL_READ_SIZE, hi - lo + 1))
+                    if not chunk:
+                        raise EOFError(f"short read: {part['url']}")
+                    lo += len(chunk)
+                    await out.put(chunk)
+                await out.put(None)
+                return
+            response = await self.open_download(part['url'], headers={"Range": f"bytes={lo}-{hi}"})
+            try:
+                response.raise_for_status()
+                # upstream ignored Range -> cut locally
+                skip = lo if response.status_code == 200 else 0
+                left = hi - lo + 1
+                async for chunk in response.aiter_raw(self.read_size):
+                    if skip:
+                        if len(chunk) <= skip:
+                            skip -= len(chunk)
+                            continue
+                        chunk, skip = chunk[skip:], 0
+                    chunk = chunk[:left]
+                    left -= len(chunk)
+                    await out.put(chunk)
+                    if left <= 0:
+                        break
+            finally:
+                await response.aclose()
+            await out.put(None)
+        except Exception as e:
+            await out.put(e)
+
+    async def iter_parts(self, parts: list[dict], start: int, end: int):
+        """
+        bytes [start, end] of a multipart file, in order. each part is streamed (aiter_raw, cut at
+        the range edges); up to PART_READ_AHEAD run concurrently, each buffering at most
+        ~PART_BUFFER_BYTES before it waits for the reader.
+        """
+        wanted = [
+            (part, max(start, part['offset']) - part['offset'], min(end, part['offset'] + part['size'] - 1) - part['offset'])
+            for part in parts
+            if part['offset'] <= end and part['offset'] + part['size'] > start
+        ]
+        depth = max(2, self.PART_BUFFER_BYTES // max(self.read_size, self.LOCAL_READ_SIZE))
+        queues = [asyncio.Queue(maxsize=depth) for _ in wanted]
+        tasks = []
+        try:
+            for i in range(len(wanted)):
+                while len(tasks) < min(i + self.PART_READ_AHEAD, len(wanted)):
+                    j = len(tasks)
+                    tasks.append(asyncio.create_task(self._fetch_part(*wanted[j], queues[j])))
+                while True:
+                    chunk = await queues[i].get()
+                    if chunk is None:
+                        break
+                    if isinstance(chunk, Exception):
+                        raise chunk
+                    yield chunk
+        finally:
+            for task in tasks:
+                task.cancel()
+            # let them close their upstream responses
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _resolve_with_fallback(self, file_uuid: str, bot_token: str | None, file_id: str) -> str | None:
+        # primary copy's bot may be revoked / rate-limited -> any replica will do
+        if bot_token:
+            try:
+                return await self._get_telegram_file_url(bot_token, file_id)
+            except httpx.HTTPError as e:
+                print(f"[Controller] getFile failed for {file_uuid}, trying replicas: {e}")
+                url = await self.get_replica_url(file_uuid)
+                if url:
+                    return url
+                raise
+        return await self.get_replica_url(file_uuid)
+
+    async def get_replica_url(self, file_uuid: str, exclude: str | None = None) -> str | None:
+        """ download url of a random replica (not the primary). None if there are no replicas """
+        slot = self._url_slot(file_uuid, "r")
+        url = (await self._get_urls([slot]))[0]
+        if url and url != exclude:
+            return url
+
+        try:
+            file_uuid_bytes = uuid.UUID(file_uuid).bytes
+        except ValueError:
+            return None
+        async with db.pool.acquire() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cursor:
+                await cursor.execute(
+                    "SELECT r.file_id, b.bot_token FROM replicas r JOIN bots b ON b.bot_id = r.bot_id WHERE r.file_uuid = %s",
+                    (file_uuid_bytes,)
+                )
+                rows = list(await cursor.fetchall())
+        random.shuffle(rows)
+        for row in rows:
+            try:
+                url = await self._get_telegram_file_url(row['bot_token'], row['file_id'])
+            except httpx.HTTPError as e:
+                print(f"[Controller] replica getFile failed for {file_uuid}: {e}")
+                continue
+            if url == exclude:
+                continue
+            await self._set_urls([(*slot, url)])
+            return url
+        return None
+
+    def _hedge_delay(self) -> float:
+        return max(self._hedge_min_delay, self._ttfb_p95)
+
+    def _record_ttfb(self, seconds: float):
+        self._ttfb.append(seconds)
+        if len(self._ttfb) % self.HEDGE_RECALC_EVERY == 0 or len(self._ttfb) == self.HEDGE_WINDOW:
+            samples = sorted(self._ttfb)
+            self._ttfb_p95 = samples[int(len(samples) * 0.95) - 1]
+
+    async def open_upstream(self, file_uuid: str, target: str) -> httpx.Response:
+        """
+        streamed GET of target. if the headers take longer than the p95 ttfb,
+        race a second request against a replica and keep whichever answers first.
+        raises httpx.RequestError if every attempt failed to connect.
+        """
+        _send = self.open_download
+
+        started = time.monotonic()
+        primary = asyncio.create_task(_send(target))
+        tasks, winner = [primary], None
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=self._hedge_delay())
+            if done:
+                self._record_ttfb(time.monotonic() - started)
+                winner = primary
+                return primary.result()
+
+            try:
+                replica_url = await self.get_replica_url(file_uuid, exclude=target)
+            except Exception as e:
+                print(f"[Controller] hedge lookup failed for {file_uuid}: {e}")
+                replica_url = None
+            if not replica_url or self.is_local(replica_url):
+                response = await primary
+                self._record_ttfb(time.monotonic() - started)
+                winner = primary
+                return response
+
+            trace = tracing.current()
+            if trace:
+                trace.root.attrs['hedged'] = True
+            tasks.append(asyncio.create_task(_send(replica_url)))
+            pending, error = set(tasks), None
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception():
+                        error = task.exception()
+                    elif winner is None and (task.result().status_code < 400 or not pending):
+                        winner = task
+
+            self._record_ttfb(time.monotonic() - started)
+            if winner is None:
+                raise error
+            return winner.result()
+        finally:
+            # losers (and everything, if our caller was cancelled): cancel, wait, close their responses
+            losers = [task for task in tasks if task is not winner]
+            for task in losers:
+                task.cancel()
+            for task in losers:
+                with contextlib.suppress(BaseException):
+                    loser = await task
+                    await loser.aclose()
+
+    async def open_download(self, url: str, headers: dict | None = None) -> httpx.Response:
+        """ streamed GET on the download pool. read it with aiter_raw(self.read_size), always aclose() """
+        client = self._download_client
+        self._dl_active += 1
+        self._dl_opened += 1
+        self._dl_peak = max(self._dl_peak, self._dl_active)
+        if self._dl_active > self._download_limit:
+            # this one waits for a free connection
+            self._dl_saturated += 1
+        try:
+            response = await client.send(client.build_request("GET", url, headers=headers), stream=True)
+        except BaseException as e:
+            self._dl_active -= 1
+            if isinstance(e, httpx.PoolTimeout):
+                self._dl_pool_timeouts += 1
+            raise
+        response.stream = _CountedStream(response.stream, self._download_closed)
+        return response
+
+    def _download_closed(self):
+        self._dl_active -= 1
+
+    def download_stats(self) -> dict:
+        return {
+            'active': self._dl_active,
+            'peak': self._dl_peak,
+            'limit': self._download_limit,
+            'opened': self._dl_opened,
+            'saturated': self._dl_saturated,
+            'pool_timeouts': self._dl_pool_timeouts,
+            'ttfb_p95_ms': round(self._ttfb_p95 * 1000, 1),
+        }
+
+    async def download_stats_task(self):
+        while True:
+            await asyncio.sleep(self.DOWNLOAD_STATS_INTERVAL)
+            stats = self.download_stats()
+            if stats['opened']:
+                print(
+                    f"[Controller Pool] downloads: {stats['opened']} opened, active {stats['active']}, "
+                    f"peak {stats['peak']}/{stats['limit']}, waited for a connection {stats['saturated']}, "
+                    f"pool timeouts {stats['pool_timeouts']}, ttfb p95 {stats['ttfb_p95_ms']}ms"
+                )
+            # per-interval counters; active is live
+            self._dl_peak = self._dl_active
+            self._dl_opened = self._dl_saturated = self._dl_pool_timeouts = 0
+
     async def _get_telegram_file_url(self, bot_token: str, file_id: str) -> str:
-        url = f'https://api.telegram.org/bot{bot_token}/getFile'
-        resp = await self._http_client.get(url, params={"file_id": file_id})
+        url = f'{self._api_url}/bot{bot_token}/getFile'
+        with tracing.span("getFile"):
+            resp = await self._http_client.get(url, params={"file_id": file_id})
         resp.raise_for_status()
         data = resp.json()
         file_path = data['result']['file_path']
-        return f'https://api.telegram.org/file/bot{bot_token}/{file_path}'
+        if self._api_local and file_path.startswith('/'):
+            return file_path
+        return f'{self._api_url}/file/bot{bot_token}/{file_path}'
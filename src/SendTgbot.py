@@ -4,110 +4,367 @@ from telegram.ext import ApplicationBuilder
 from telegram.error import RetryAfter
 import aiomysql
 from . import db
+from . import tracing
 import uuid
 import os
+import collections
+import contextlib
+import time
+from pathlib import Path
 
 class Tgbot:
     _bot_id: int
     _token: str
-    _chat_id: str
+    _chat_ids: list[int]
+    _chat_next_ok: dict[int, float]
     _worker_task: asyncio.Task | None
     len_q: int
     busy: bool
     batch_size: int
+    replicas: int
+    peers: list["Tgbot"]
     MAX_FLOOD_RETRIES = 5
+    # telegram: ~20 msgs/min per bot per group -> min gap per (bot, chat) pair
+    CHAT_SEND_INTERVAL = 3.0
+    # per-job upload time EWMA (sec) used for dispatching
+    INITIAL_LATENCY = 1.0
+    LATENCY_ALPHA = 0.2
+    # claim share per queues.priority (interactive : bulk)
+    PRIORITY_WEIGHTS = {db.PRIORITY_INTERACTIVE: 8, db.PRIORITY_BULK: 2}
+    # background replications per bot at once
+    REPLICA_CONCURRENCY = 2
 
-    def __init__(self, bot_id: int, token: str, chat_id: str, batch_size: int = 10):
+    def __init__(self, bot_id: int, token: str, chat_ids: list[int], batch_size: int = 10, replicas: int = 1,
+                 api_url: str | None = None, local_mode: bool = False):
         self._bot_id = bot_id
         self._token = token
-        self._chat_id = chat_id
+        # self-hosted bot api server; local_mode = it runs with --local and shares our tmp dir
+        self._api_url = api_url.rstrip('/') if api_url else None
+        self._local_mode = local_mode
+        # rotate so bots don't all start on the same chat
+        offset = bot_id % len(chat_ids)
+        self._chat_ids = chat_ids[offset:] + chat_ids[:offset]
+        self._chat_next_ok = {chat_id: 0.0 for chat_id in self._chat_ids}
         self._worker_task = None
         self.batch_size = batch_size
+        # total copies per file (1 = no replication). peers are wired up by main
+        self.replicas = replicas
+        self.peers = []
+        self._replica_rr = 0
+        self._replica_sem = asyncio.Semaphore(self.REPLICA_CONCURRENCY)
+        self._replica_tasks: set[asyncio.Task] = set()
+        # uuids whose tmp file is still needed by a background replication (Controller.reconcile_tmp skips them)
+        self.replicating: set[bytes] = set()
         self.busy = False 
+        # fed by Controller's dispatcher; peers steal from it when idle
+        self.inbox = collections.deque()
+        self._wakeup = asyncio.Event()
+        self.in_flight = 0
+        self.latency = self.INITIAL_LATENCY
+        # async hook(file_uuid bytes) after a files row is committed (set by Controller)
+        self.on_indexed = None
+        # sync hook(bot) after every job, so the dispatcher refills the inbox right away (set by Controller)
+        self.on_job_done = None
     
+    # dispatcher-facing load signals
+    @property
+    def backlog(self) -> int:
+        return len(self.inbox) + self.in_flight
+
+    def throttled_for(self) -> float:
+        # sec until any (bot, chat) pair may send again
+        return max(0.0, min(self._chat_next_ok.values()) - time.monotonic())
+
+    def expected_wait(self) -> float:
+        # rough time until a newly assigned job would finish here
+        return (self.backlog + 1) * self.latency + self.throttled_for()
+
+    def assign(self, job: dict):
+        job['assigned_ns'] = time.time_ns()
+        self.inbox.append(job)
+        self._wakeup.set()
+
+    def _next_job(self) -> dict | None:
+        if self.inbox:
+            return self.inbox.popleft()
+        # idle -> steal the newest job of the most backed-up peer
+        victims = [p for p in self.peers if p.inbox]
+        if not victims:
+            return None
+        victim = max(victims, key=lambda p: p.expected_wait())
+        return victim.inbox.pop()
+
     async def _queue_worker(self):
         print(f"sbot[{self._bot_id}]: _queue_worker started.")
         try:
             while True:
-                claimed_jobs = await self._fetch_and_claim_jobs()
+                job = self._next_job()
 
-                if not claimed_jobs:
-                    await asyncio.sleep(5)
+                if job is None:
+                    self._wakeup.clear()
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=5)
                     continue
 
-                for job in claimed_jobs:
-                    _file_uuid_bytes = job['file_uuid']
-                    _file_uuid_str = str(uuid.UUID(bytes=_file_uuid_bytes))
-                    _path = f"./tmp/{_file_uuid_str}"
-                    try:
-                        self.busy = True 
-                        
-                        # state 10 -> 20 (Upload Started)
-                        await self._update_state(
-                                file_uuid=_file_uuid_bytes, 
-                                state=20, 
-                                exp_state=[10])
-                        
-                        _msg_id, _file_id = await self._send_file(path = _path, caption = _file_uuid_str)
-                        
-                        # state 20 -> 30 (Upload Finished, wait for commit)
-                        await self._update_state(
-                                file_uuid=_file_uuid_bytes,
-                                state=30,
-                                exp_state=[20])
-
-                        ok = await self._write_index(
-                            file_uuid=_file_uuid_bytes, 
-                            msg_id=_msg_id, 
-                            file_id = _file_id
-                            )
-
-                        if ok:
-                            try:
-                                # gc loop state 30 redo에서도 진행해야 함.
-                                # committed state = 40 <-> do not req any other actions
-                                os.remove(_path)
-                            except OSError as e:
-                                print(f"sbot[{self._bot_id}]: Error deleting temp file {_path}: {e}")
-
-                    except Exception as e:
-                        print(f"sbot[{self._bot_id}]: Error processing file {_file_uuid_str}: {e}")
-                        try:
-                            await self._mark_fail(_file_uuid_bytes, str(e))
-                            print(f"sbot[{self._bot_id}]: File {_file_uuid_str} marked as failed.")
-                        except Exception as e2:
-                            print(f"sbot[{self._bot_id}]: fail mark error:", e2)
-                    finally:
-                        self.busy = False  
+                await self._process_job(job)
 
         except asyncio.CancelledError:
             print(f"sbot[{self._bot_id}]: _queue_worker cancelled.")
             pass
-    
-    async def _send_file(self, path: str, caption: str):
+
+    async def _process_job(self, job: dict):
+        _file_uuid_bytes = job['file_uuid']
+        _file_uuid_str = str(uuid.UUID(bytes=_file_uuid_bytes))
+        _path = f"./tmp/{_file_uuid_str}"
+        trace = tracing.start_trace("upload_job", file_uuid=_file_uuid_str, bot_id=self._bot_id)
+        ok = False
+        replicating = False
+        try:
+            self.busy = True 
+            self.in_flight += 1
+            started = time.monotonic()
+            if trace and 'assigned_ns' in job:
+                # time spent in state 10 (dispatched, waiting in an inbox)
+                trace.record("state_10", job['assigned_ns'], time.time_ns())
+            
+            with tracing.span("state_20"):
+                # state 10 -> 20 (Upload Started)
+                started_ok = await self._update_state(
+                        file_uuid=_file_uuid_bytes, 
+                        state=20, 
+                        exp_state=[10])
+                if not started_ok:
+                    # duplicate / gc-reset job: someone else owns (or finished) it -> don't upload twice
+                    print(f"sbot[{self._bot_id}]: {_file_uuid_str} is no longer in state 10, skipping.")
+                    return
+                
+                _size = os.path.getsize(_path)
+                if _size > db.PART_SIZE_BYTES:
+                    # part 0 doubles as the files row; the rest live in parts
+                    _parts = await self._send_parts(_file_uuid_bytes, _path, _file_uuid_str, _size)
+                    _msg_id, _file_id, _chat_id = _parts[0]['msg_id'], _parts[0]['file_id'], _parts[0]['chat_id']
+                else:
+                    _parts = None
+                    _msg_id, _file_id, _chat_id = await self._send_file(path = _path, caption = _file_uuid_str)
+            self.latency += self.LATENCY_ALPHA * (time.monotonic() - started - self.latency)
+            
+            # multipart files aren't replicated (see README)
+            if self.replicas > 1 and not _parts:
+                # claimed before state 40 is visible, so reconcile never sees it indexed w/o the claim
+                self.replicating.add(_file_uuid_bytes)
+                replicating = True
+
+            with tracing.span("state_30"):
+                # state 20 -> 30 (Upload Finished, wait for commit)
+                # msg/file/chat ids recorded so gc can redo the commit
+                await self._update_state(
+                        file_uuid=_file_uuid_bytes,
+                        state=30,
+                        exp_state=[20],
+                        extra={'file_id': _file_id, 'msg_id': _msg_id, 'chat_id': _chat_id,
+                               'part_count': len(_parts) if _parts else 1})
+
+                ok = await self._write_index(
+                    file_uuid=_file_uuid_bytes, 
+                    msg_id=_msg_id, 
+                    file_id = _file_id,
+                    chat_id = _chat_id
+                    )
+
+            if ok:
+                if self.on_indexed:
+                    await self.on_indexed(_file_uuid_bytes)
+                if replicating:
+                    # off the queue: the next job doesn't wait for the copies, tmp goes once they're sent
+                    task = asyncio.create_task(self._replicate_then_remove(_file_uuid_bytes, _path, _file_uuid_str, _chat_id))
+                    self._replica_tasks.add(task)
+                    task.add_done_callback(self._replica_tasks.discard)
+                    replicating = False # the task releases it
+                else:
+                    self._remove_tmp(_path)
+
+        except Exception as e:
+            print(f"sbot[{self._bot_id}]: Error processing file {_file_uuid_str}: {e}")
+            try:
+                await self._mark_fail(_file_uuid_bytes, str(e))
+                print(f"sbot[{self._bot_id}]: File {_file_uuid_str} marked as failed.")
+            except Exception as e2:
+                print(f"sbot[{self._bot_id}]: fail mark error:", e2)
+        finally:
+            if replicating:
+                self.replicating.discard(_file_uuid_bytes)
+            self.busy = False
+            self.in_flight -= 1
+            tracing.end_trace(trace, ok=ok)
+            if self.on_job_done:
+                self.on_job_done(self)
+
+    async def _next_chat(self, avoid_chat_id: int | None = None) -> int:
+        # (bot, chat) pair that frees up first; wait if every pair is cooling down
+        # avoid_chat_id: replicas prefer a different chat than the primary copy
+        candidates = [c for c in self._chat_ids if c != avoid_chat_id] or self._chat_ids
+        chat_id = min(candidates, key=self._chat_next_ok.__getitem__)
+        delay = self._chat_next_ok[chat_id] - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self._chat_next_ok[chat_id] = time.monotonic() + self.CHAT_SEND_INTERVAL
+        return chat_id
+
+    async def _send_file(self, path: str, caption: str, avoid_chat_id: int | None = None,
+                         offset: int = 0, length: int | None = None) -> tuple[int, str, int]:
+        # offset/length: send only that slice of path (parts)
         bot = self._app.bot
         for attempt in range(self.MAX_FLOOD_RETRIES):
+            with tracing.span("chat_wait"):
+                chat_id = await self._next_chat(avoid_chat_id)
             try:
-                with open(path, "rb") as f:
+                if length is None and self._local_mode:
+                    # passed by path (file:// uri), the server reads it from disk
+                    msg = await bot.send_document(
+                            chat_id=chat_id,
+                            document = Path(path).absolute(),
+                            caption = caption,
+                            read_timeout = 60,
+                            write_timeout = 60,
+                            connect_timeout = 60
+                            )
+                elif length is None:
+                    with open(path, "rb") as f:
+                        msg = await bot.send_document(
+                                chat_id=chat_id,
+                                document = f,
+                                caption = caption,
+                                read_timeout = 60,
+                                write_timeout = 60,
+                                connect_timeout = 60
+                                )
+                else:
+                    data = await asyncio.to_thread(self._read_slice, path, offset, length)
                     msg = await bot.send_document(
-                            chat_id=self._chat_id,
-                            document = f,
+                            chat_id=chat_id,
+                            document = data,
+                            filename = caption,
                             caption = caption,
                             read_timeout = 60,
                             write_timeout = 60,
                             connect_timeout = 60
                             )
-                return msg.message_id, msg.document.file_id
+                return msg.message_id, msg.document.file_id, chat_id
             except RetryAfter as e:
-                print(f"sbot[{self._bot_id}]: Flood control exceeded for file {path}. Waiting for {e.retry_after}s. Attempt {attempt+1}/{self.MAX_FLOOD_RETRIES}")
-                await asyncio.sleep(e.retry_after)
+                # park only this pair; the next attempt goes to another chat if one is free
+                print(f"sbot[{self._bot_id}]: Flood control exceeded for file {path} in chat {chat_id}. Parking for {e.retry_after}s. Attempt {attempt+1}/{self.MAX_FLOOD_RETRIES}")
+                self._chat_next_ok[chat_id] = time.monotonic() + float(e.retry_after)
             except Exception as e:
                 # 스코프에서 버려 ㅇㅇ
                 raise e
         
         raise Exception(f"Failed to send file {path} after {self.MAX_FLOOD_RETRIES} flood control retries.")
         
-    async def _fetch_and_claim_jobs(self) -> list[dict]:
+    @staticmethod
+    def _read_slice(path: str, offset: int, length: int) -> bytes:
+        with open(path, "rb") as f:
+            f.seek(offset)
+            return f.read(length)
+
+    async def _send_parts(self, file_uuid: bytes, path: str, caption: str, size: int) -> list[dict]:
+        """
+        split path into PART_SIZE_BYTES slices, round-robin them over self + peers
+        (each bot sends its slices in order, bots run in parallel) and record them in parts.
+        any failed part fails the whole job -> normal state 100 retry.
+        """
+        bots = [self] + self.peers
+        count = -(-size // db.PART_SIZE_BYTES)
+        parts = [
+            {'part_no': i, 'part_offset': i * db.PART_SIZE_BYTES,
+             'part_size': min(db.PART_SIZE_BYTES, size - i * db.PART_SIZE_BYTES),
+             'bot': bots[i % len(bots)]}
+            for i in range(count)
+        ]
+
+        async def _run(bot: "Tgbot", mine: list[dict]):
+            for part in mine:
+                part['msg_id'], part['file_id'], part['chat_id'] = await bot._send_file(
+                    path=path,
+                    caption=f"{caption} {part['part_no'] + 1}/{count}",
+                    offset=part['part_offset'],
+                    length=part['part_size'])
+
+        await asyncio.gather(*(_run(bot, [p for p in parts if p['bot'] is bot]) for bot in bots))
+
+        async with db.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                # REPLACE: a retried job overwrites the rows of its failed attempt
+                await cursor.executemany(
+                    """
+                    REPLACE INTO parts (file_uuid, part_no, part_offset, part_size, bot_id, file_id, msg_id, chat_id)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                    """,
+                    [(file_uuid, p['part_no'], p['part_offset'], p['part_size'], p['bot']._bot_id,
+                      p['file_id'], p['msg_id'], p['chat_id']) for p in parts]
+                )
+                await conn.commit()
+        return parts
+
+    def _remove_tmp(self, path: str):
+        try:
+            # gc loop state 30 redo에서도 진행해야 함.
+            # committed state = 40 <-> do not req any other actions
+            os.remove(path)
+        except OSError as e:
+            print(f"sbot[{self._bot_id}]: Error deleting temp file {path}: {e}")
+
+    async def _replicate_then_remove(self, file_uuid: bytes, path: str, caption: str, primary_chat_id: int):
+        try:
+            async with self._replica_sem:
+                await self._replicate(file_uuid, path, caption, primary_chat_id)
+        except Exception as e:
+            print(f"sbot[{self._bot_id}]: replication failed for {caption}: {e}")
+        finally:
+            self._remove_tmp(path)
+            self.replicating.discard(file_uuid)
+
+    async def _replicate(self, file_uuid: bytes, path: str, caption: str, primary_chat_id: int):
+        """
+        best effort: upload the same tmp file through replicas-1 peer bots concurrently.
+        the primary is already indexed, so failures here only cost redundancy.
+        """
+        n = min(self.replicas - 1, len(self.peers))
+        if n <= 0:
+            return
+        start = self._replica_rr % len(self.peers)
+        self._replica_rr += 1
+        targets = (self.peers[start:] + self.peers[:start])[:n]
+
+        results = await asyncio.gather(
+            *(peer._send_file(path=path, caption=caption, avoid_chat_id=primary_chat_id) for peer in targets),
+            return_exceptions=True
+        )
+        rows = []
+        for peer, result in zip(targets, results):
+            if isinstance(result, BaseException):
+                print(f"sbot[{self._bot_id}]: replica via sbot[{peer._bot_id}] failed for {caption}: {result}")
+                continue
+            msg_id, file_id, chat_id = result
+            rows.append((file_uuid, peer._bot_id, file_id, msg_id, chat_id))
+        if not rows:
+            return
+
+        async with db.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                try:
+                    await cursor.executemany(
+                        """
+                        INSERT IGNORE INTO replicas (file_uuid, bot_id, file_id, msg_id, chat_id)
+                        VALUES (%s, %s, %s, %s, %s)
+                        """,
+                        rows
+                    )
+                    await conn.commit()
+                except Exception as e:
+                    print(f"sbot[{self._bot_id}]: replica index error for {caption}: {e}")
+
+    async def _fetch_and_claim_jobs(self, limit: int | None = None) -> list[dict]:
+        limit = limit or self.batch_size
         if not db.pool:
             raise RuntimeError("Database pool is not initialized.")
         
@@ -115,18 +372,30 @@ class Tgbot:
             async with conn.cursor(aiomysql.DictCursor) as cursor:
                 await conn.begin()
                 try:
-                    await cursor.execute(
-                        """
-                        SELECT file_uuid
-                        FROM queues
-                        WHERE state = 0 AND available_at <= NOW()
-                        ORDER BY created_at ASC
-                        LIMIT %s
-                        FOR UPDATE SKIP LOCKED
-                        """,
-                        (self.batch_size,)
-                    )
-                    jobs_to_claim = await cursor.fetchall()
+                    jobs_to_claim = []
+                    for priority, quota in self._priority_quotas(limit):
+                        quota = min(quota, limit - len(jobs_to_claim))
+                        if quota > 0:
+                            jobs_to_claim += await self._select_fair(cursor, priority, quota)
+
+                    # leftover capacity (idle lanes) -> strict priority, FIFO.
+                    # SKIP LOCKED doesn't skip our own locks -> exclude what we already picked
+                    remaining = limit - len(jobs_to_claim)
+                    if remaining > 0:
+                        picked = [job['file_uuid'] for job in jobs_to_claim]
+                        not_picked = f"AND file_uuid NOT IN ({', '.join(['%s'] * len(picked))})" if picked else ""
+                        await cursor.execute(
+                            f"""
+                            SELECT file_uuid
+                            FROM queues
+                            WHERE state = 0 AND available_at <= NOW() {not_picked}
+                            ORDER BY priority ASC, created_at ASC
+                            LIMIT %s
+                            FOR UPDATE SKIP LOCKED
+                            """,
+                            (*picked, remaining)
+                        )
+                        jobs_to_claim += await cursor.fetchall()
                     
                     if not jobs_to_claim:
                         await conn.commit()
@@ -151,21 +420,75 @@ class Tgbot:
                     print(f"sbot[{self._bot_id}]: Error claiming jobs: {e}")
                     return []
     
-    async def _write_index(self, file_uuid: bytes, msg_id: int, file_id: str) -> bool:
+    def _priority_quotas(self, limit: int) -> list[tuple[int, int]]:
+        # limit split by PRIORITY_WEIGHTS; every lane keeps >= 1 slot so bulk never starves
+        total = sum(self.PRIORITY_WEIGHTS.values())
+        return [
+            (priority, max(1, limit * weight // total))
+            for priority, weight in sorted(self.PRIORITY_WEIGHTS.items())
+        ]
+
+    async def _select_fair(self, cursor, priority: int, quota: int) -> list[dict]:
+        """
+        claim up to quota ready jobs of one priority, split evenly across client lanes
+        (oldest waiting lane first) so one client can't hog the class.
+        caller holds the transaction.
+        """
+        # no available_at filter here: lane + MIN(created_at) is a loose scan of idx_claim_ready
+        # (one probe per lane, not per row). lanes that are all backing off just yield nothing below
+        await cursor.execute(
+            """
+            SELECT lane
+            FROM queues
+            WHERE state = 0 AND priority = %s
+            GROUP BY lane
+            ORDER BY MIN(created_at) ASC
+            LIMIT %s
+            """,
+            (priority, quota)
+        )
+        lanes = [row['lane'] for row in await cursor.fetchall()]
+        if not lanes:
+            return []
+
+        per_lane = max(1, quota // len(lanes))
+        jobs = []
+        for lane in lanes:
+            await cursor.execute(
+                """
+                SELECT file_uuid
+                FROM queues
+                WHERE state = 0 AND priority = %s AND lane = %s AND available_at <= NOW()
+                ORDER BY created_at ASC
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+                """,
+                (priority, lane, min(per_lane, quota - len(jobs)))
+            )
+            jobs += await cursor.fetchall()
+            if len(jobs) >= quota:
+                break
+        return jobs
+
+    async def _write_index(self, file_uuid: bytes, msg_id: int, file_id: str, chat_id: int) -> bool:
         if not db.pool: raise RuntimeError("Database pool is not initialized.")
         
         async with db.pool.acquire() as conn:
             async with conn.cursor() as cursor:
                 await conn.begin() # Start transaction
                 try:
-                    # 1. INSERT into files table
+                    # 1. INSERT into files table (metadata carried over from queues)
                     await cursor.execute(
                         """
-                        INSERT INTO files (file_uuid, file_id, msg_id, bot_id)
-                        VALUES (%s, %s, %s, %s)
+                        INSERT INTO files (file_uuid, file_id, msg_id, bot_id, chat_id, part_count, file_size, mime_type, sha256, width, height)
+                        SELECT %s, %s, %s, %s, %s, part_count, file_size, mime_type, sha256, width, height
+                        FROM queues
+                        WHERE file_uuid = %s
                         """,
-                        (file_uuid, file_id, msg_id, self._bot_id)
+                        (file_uuid, file_id, msg_id, self._bot_id, chat_id, file_uuid)
                     )
+                    if cursor.rowcount != 1:
+                        raise RuntimeError("queue row vanished before commit")
 
                     # 2. UPDATE queues table
                     await cursor.execute(
@@ -205,7 +528,7 @@ class Tgbot:
                     print(f"sbot[{self._bot_id}]: _mark_fail error: {e}")
                     return 0
 
-    async def _update_state(self, file_uuid: bytes, state: int, exp_state: list[int]) -> int:
+    async def _update_state(self, file_uuid: bytes, state: int, exp_state: list[int], extra: dict | None = None) -> int:
         if not db.pool:
             raise RuntimeError("Database pool is not initialized.")
 
@@ -213,13 +536,16 @@ class Tgbot:
             async with conn.cursor() as cursor:
                 try:
                     exp_state_placeholders = ', '.join(['%s'] * len(exp_state))
+                    extra = extra or {}
+                    # column names are ours, never user input
+                    extra_sets = ''.join(f", {col} = %s" for col in extra)
                     
                     query = f"""
                         UPDATE queues
-                        SET state = %s, bot_id = %s, updated_at = NOW()
+                        SET state = %s, bot_id = %s, updated_at = NOW(){extra_sets}
                         WHERE file_uuid = %s AND state IN ({exp_state_placeholders})
                     """
-                    params = (state, self._bot_id, file_uuid, *exp_state)
+                    params = (state, self._bot_id, *extra.values(), file_uuid, *exp_state)
                     
                     await cursor.execute(query, params)
                     await conn.commit()
@@ -229,7 +555,12 @@ class Tgbot:
                     print(f"sbot[{self._bot_id}]: _update_state error: {e}")
                     return 0            
     def build(self):
-        app = ApplicationBuilder().token(self._token).build()
+        builder = ApplicationBuilder().token(self._token)
+        if self._api_url:
+            builder = builder.base_url(f"{self._api_url}/bot").base_file_url(f"{self._api_url}/file/bot")
+        if self._local_mode:
+            builder = builder.local_mode(True)
+        app = builder.build()
         self._app = app
         return app
 
@@ -244,4 +575,8 @@ class Tgbot:
                 await self._worker_task
             except asyncio.CancelledError:
                 pass
-            self._worker_task = None
\ No newline at end of file
+            self._worker_task = None
+        # unfinished replicas are dropped (best effort); their tmp files are removed on cancel
+        for task in list(self._replica_tasks):
+            task.cancel()
+        await asyncio.gather(*self._replica_tasks, return_exceptions=True)
\ No newline at end of file
@@ -1,8 +1,11 @@
 import asyncio
-from fastapi import FastAPI, Request, Response, UploadFile, File, HTTPException
-from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
+import contextlib
+from fastapi import FastAPI, Request, Response, UploadFile, File, Form, HTTPException
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse, FileResponse
 from starlette.background import BackgroundTask
 from . import db
+from . import tracing
+from . import variants
 from io import BytesIO
 import httpx
 import os
@@ -10,14 +13,52 @@ import uuid
 from uuid_extensions import uuid7
 from typing import Dict, Any
 import aiofiles
+import hashlib
+import ipaddress
+import re
+import struct
+import tempfile
+import time
 
 TEMP_DIR = "./tmp"
-MAX_FILE_SIZE_MB = 20
+# > db.PART_SIZE_BYTES is stored as parts (bot api download limit)
+MAX_FILE_SIZE_MB = 200
 MAX_FILE_SIZE_BYTES = MAX_FILE_SIZE_MB * 1024 * 1024
+MAX_LANE_LEN = 64
+# fair queuing lane = peer addr (ipv6: its /64). X-Client-Id is only honoured from these proxies (ips / cidrs)
+TRUSTED_PROXIES = [ipaddress.ip_network(p.strip(), strict=False) for p in os.getenv("TRUSTED_PROXIES", "").split(",") if p.strip()]
+# a lane with this many interactive jobs waiting gets its further interactive uploads queued as bulk
+INTERACTIVE_LANE_MAX = int(os.getenv("INTERACTIVE_LANE_MAX", 20))
+VARIANT_DIR = os.getenv("VARIANT_DIR", "./variants")
+# also push generated derivatives through the bot pipeline as their own files
+VARIANT_UPLOAD = os.getenv("VARIANT_UPLOAD", "0") == "1"
+# no derivatives of originals above this (they're staged on disk and decoded in full)
+VARIANT_MAX_SOURCE_MB = int(os.getenv("VARIANT_MAX_SOURCE_MB", 50))
+VARIANT_MAX_SOURCE_BYTES = VARIANT_MAX_SOURCE_MB * 1024 * 1024
+# entity-tag, optionally weak: W/"..."
+ETAG_RE = re.compile(r'(?:W/)?"[^"]*"')
 ALLOWED_MIMETYPES = {
     'image/jpeg', 'image/png', 'image/gif', 'image/webp', 'image/bmp'
 }
 
+class _ClosingStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse that always awaits on_close once it's done: also when the client left
+    before the body was iterated (the generator's finally never runs then, and starlette
+    skips background tasks on a disconnect).
+    """
+
+    def __init__(self, *args, on_close=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._on_close = on_close
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            if self._on_close:
+                await self._on_close()
+
 def create_app(lifespan_context=None):
     app = FastAPI()
 
@@ -48,22 +89,256 @@ def create_app(lifespan_context=None):
         elif head.startswith(b'BM'):
             return 'image/bmp'
         return 'application/octet-stream'
-    
-    async def _handle_upload(file_uuid: str):
+
+    def _sniff_image_size(head: bytes, mime: str) -> tuple[int | None, int | None]:
+        # header-only parse. (None, None) if the dims are not in head
+        try:
+            if mime == 'image/png' and len(head) >= 24:
+                return struct.unpack('>II', head[16:24])
+            if mime == 'image/gif' and len(head) >= 10:
+                return struct.unpack('<HH', head[6:10])
+            if mime == 'image/bmp' and len(head) >= 26:
+                w, h = struct.unpack('<ii', head[18:26])
+                return w, abs(h)
+            if mime == 'image/webp' and len(head) >= 30:
+                chunk = head[12:16]
+                if chunk == b'VP8 ':
+                    w, h = struct.unpack('<HH', head[26:30])
+                    return w & 0x3fff, h & 0x3fff
+                if chunk == b'VP8L':
+                    bits = int.from_bytes(head[21:25], 'little')
+                    return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+                if chunk == b'VP8X':
+                    return int.from_bytes(head[24:27], 'little') + 1, int.from_bytes(head[27:30], 'little') + 1
+            if mime == 'image/jpeg':
+                i = 2
+                while i + 9 < len(head):
+                    if head[i] != 0xff:
+                        i += 1
+                        continue
+                    marker = head[i + 1]
+                    if marker == 0xff:
+                        i += 1
+                        continue
+                    if marker in (0xd8, 0x01) or 0xd0 <= marker <= 0xd7:
+                        i += 2
+                        continue
+                    # SOF0..SOF15 except DHT, JPG, DAC
+                    if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+                        h, w = struct.unpack('>HH', head[i + 5:i + 9])
+                        return w, h
+                    i += 2 + struct.unpack('>H', head[i + 2:i + 4])[0]
+        except struct.error:
+            pass
+        return None, None
+
+    def _upload_lane(request: Request) -> str:
+        # fair queuing key: peer addr, or X-Client-Id when a trusted proxy set it (clients can't pick their own lane)
+        host = request.client.host if request.client else ''
+        try:
+            ip = ipaddress.ip_address(host)
+        except ValueError:
+            return host[:MAX_LANE_LEN]
+        client_id = request.headers.get('x-client-id')
+        if client_id and any(ip in net for net in TRUSTED_PROXIES):
+            return client_id[:MAX_LANE_LEN]
+        if ip.version == 6:
+            # one host usually owns the whole /64
+            return str(ipaddress.ip_network(f"{ip}/64", strict=False))
+        return str(ip)
+
+    async def _handle_upload(file_uuid: str, meta: Dict[str, Any], priority: int, lane: str):
         if not db.pool:
             raise RuntimeError("Database pool is not initialized.")
     
         async with db.pool.acquire() as conn:
             async with conn.cursor() as cursor:
+                if priority == db.PRIORITY_INTERACTIVE:
+                    # a lane flooding the interactive class (e.g. an untagged crawler) is demoted to bulk
+                    await cursor.execute(
+                        """
+                        SELECT COUNT(*) FROM (
+                            SELECT 1 FROM queues WHERE state = 0 AND priority = %s AND lane = %s LIMIT %s
+                        ) t
+                        """,
+                        (db.PRIORITY_INTERACTIVE, lane, INTERACTIVE_LANE_MAX)
+                    )
+                    if (await cursor.fetchone())[0] >= INTERACTIVE_LANE_MAX:
+                        priority = db.PRIORITY_BULK
                 # 이 이후의 데이터에 대해서는 일관성을 보장
                 await cursor.execute(
-                    "INSERT INTO queues (file_uuid) VALUES (%s)",
-                    (uuid.UUID(file_uuid).bytes,)
+                    """
+                    INSERT INTO queues (file_uuid, file_size, mime_type, sha256, width, height, priority, lane)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                    """,
+                    (uuid.UUID(file_uuid).bytes, meta['size'], meta['mime'], meta['sha256'], meta['width'], meta['height'], priority, lane)
                 )
                 return cursor.lastrowid
 
+    async def _lookup_variant(file_uuid: str, key: str) -> str | None:
+        # indexed copy of a derivative (VARIANT_UPLOAD), only once its own upload committed
+        async with db.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    """
+                    SELECT v.variant_uuid
+                    FROM variants v JOIN files f ON f.file_uuid = v.variant_uuid
+                    WHERE v.file_uuid = %s AND v.params = %s
+                    """,
+                    (uuid.UUID(file_uuid).bytes, key)
+                )
+                row = await cursor.fetchone()
+        return str(uuid.UUID(bytes=row[0])) if row else None
+
+    async def _upload_variant(_controller, file_uuid: str, key: str, data: bytes, meta: Dict[str, Any]):
+        variant_uuid = str(uuid7(as_type="str"))
+        async with aiofiles.open(os.path.join(TEMP_DIR, variant_uuid), 'wb') as f:
+            await f.write(data)
+        await _handle_upload(variant_uuid, meta, db.PRIORITY_BULK, 'variants')
+        async with db.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    "INSERT IGNORE INTO variants (file_uuid, params, variant_uuid) VALUES (%s, %s, %s)",
+                    (uuid.UUID(file_uuid).bytes, key, uuid.UUID(variant_uuid).bytes)
+                )
+        _controller.notify_enqueued()
+
+    async def _download_original(_controller, file_uuid: str, meta: dict, dest: str) -> str:
+        """ original -> path on disk for the render pool: the local bot api file, or streamed into dest """
+        async def chunks(url: str | None):
+            if meta.get('parts', 1) > 1:
+                parts = await _controller.get_parts(file_uuid)
+                if not parts:
+                    raise RuntimeError("could not resolve file parts")
+                async for chunk in _controller.iter_parts(parts, 0, meta['size'] - 1):
+                    yield chunk
+                return
+            upstream_response = await _controller.open_upstream(file_uuid, url)
+            try:
+                upstream_response.raise_for_status()
+                async for chunk in upstream_response.aiter_raw(_controller.read_size):
+                    yield chunk
+            finally:
+                await upstream_response.aclose()
+
+        cached = None
+        if meta.get('parts', 1) <= 1:
+            cached = await _controller.get_cache(file_uuid)
+            if cached is None:
+                raise RuntimeError("file vanished from the index")
+            if _controller.is_local(cached[0]):
+                return cached[0]
+
+        written = 0
+        async with aiofiles.open(dest, 'wb') as f, contextlib.aclosing(chunks(cached and cached[0])) as stream:
+            async for chunk in stream:
+                written += len(chunk)
+                if written > VARIANT_MAX_SOURCE_BYTES:
+                    raise RuntimeError(f"original exceeds {VARIANT_MAX_SOURCE_MB} MB")
+                await f.write(chunk)
+        return dest
+
+    def _remove_quiet(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _write_atomic(path: str, data: bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.part"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    async def _build_variant(request: Request, file_uuid: str, meta: dict, params: tuple, key: str, path: str):
+        _controller = request.app.state.controller
+        width, height, fmt = params
+        os.makedirs(VARIANT_DIR, exist_ok=True)
+        fd, staged = tempfile.mkstemp(dir=VARIANT_DIR, suffix='.src')
+        os.close(fd)
+        try:
+            with tracing.span("variant_download"):
+                src = await _download_original(_controller, file_uuid, meta, staged)
+            with tracing.span("variant_render", key=key):
+                loop = asyncio.get_running_loop()
+                out, out_w, out_h = await loop.run_in_executor(
+                    request.app.state.variant_pool, variants.render, src, width, height, fmt
+                )
+        finally:
+            await asyncio.to_thread(_remove_quiet, staged)
+        await asyncio.to_thread(_write_atomic, path, out)
+
+        if VARIANT_UPLOAD:
+            try:
+                await _upload_variant(_controller, file_uuid, key, out, {
+                    'size': len(out),
+                    'mime': variants.FORMATS[fmt],
+                    'sha256': hashlib.sha256(out).digest(),
+                    'width': out_w,
+                    'height': out_h,
+                })
+            except Exception as e:
+                print(f"[API]: variant upload failed ({file_uuid} {key}): {e}")
+
+    # path -> build in progress; concurrent requests for the same derivative share it
+    _variant_builds: Dict[str, asyncio.Task] = {}
+
+    async def _variant_response(file_uuid: str, params: tuple, request: Request):
+        _controller = request.app.state.controller
+        meta = await _controller.get_meta(file_uuid)
+        if meta is None:
+            return JSONResponse(
+                status_code=404,
+                content={"detail": "File not found. It may be in processing or the UUID is invalid."}
+            )
+        file_uuid = str(uuid.UUID(file_uuid))
+        width, height, fmt = params
+        key = variants.params_key(width, height, fmt)
+        path = variants.cache_path(VARIANT_DIR, file_uuid, key)
+
+        headers = {
+            'Content-Disposition': f'inline; filename="{file_uuid}_{key}"',
+            'Cache-Control': 'public, max-age=8640000',
+            'Access-Control-Allow-Origin': "*"
+        }
+        if meta.get('sha256'):
+            headers['ETag'] = f'"{meta["sha256"]}-{key}"'
+        if_none_match = request.headers.get('if-none-match')
+        if if_none_match and _etag_matches(if_none_match, headers.get('ETag')):
+            return Response(status_code=304, headers=headers)
+
+        if os.path.exists(path):
+            # cache hit: bump mtime, variants.evict drops the least recently served first
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        else:
+            if (meta.get('size') or 0) > VARIANT_MAX_SOURCE_BYTES:
+                return JSONResponse(
+                    status_code=413,
+                    content={"detail": f"Derivatives are only built for originals up to {VARIANT_MAX_SOURCE_MB} MB."}
+                )
+            variant_uuid = await _lookup_variant(file_uuid, key)
+            if variant_uuid:
+                return await _content(variant_uuid, request, allow_variants=False)
+
+            build = _variant_builds.get(path)
+            if build is None:
+                build = asyncio.create_task(_build_variant(request, file_uuid, meta, params, key, path))
+                _variant_builds[path] = build
+                build.add_done_callback(lambda _: _variant_builds.pop(path, None))
+            try:
+                await asyncio.shield(build)
+            except Exception as e:
+                print(f"[API]: variant build failed ({file_uuid} {key}): {e}")
+                return JSONResponse(status_code=500, content={"detail": "Could not build derivative."})
+
+        return FileResponse(path, headers=headers, media_type=variants.FORMATS[fmt])
+
     @app.post("/upload")
-    async def upload(request: Request, file: UploadFile = File(...)):
+    async def upload(request: Request, file: UploadFile = File(...), priority: str | None = Form(None)):
 
         def ret_err(code):
             return JSONResponse(content={
@@ -77,13 +352,18 @@ def create_app(lifespan_context=None):
         if file.content_type not in ALLOWED_MIMETYPES:
             return ret_err(415)
 
+        priority = priority or request.headers.get('x-upload-priority') or 'interactive'
+        if priority not in db.PRIORITIES:
+            return ret_err(400)
+
         try:
             initial_chunk = await file.read(1024) # test
             await file.seek(0)
         except Exception:
             return ret_err(400)
 
-        if _sniff_image_mime(initial_chunk) not in ALLOWED_MIMETYPES:
+        mime_type = _sniff_image_mime(initial_chunk)
+        if mime_type not in ALLOWED_MIMETYPES:
             return ret_err(415)
 
         # uuid7으로
@@ -91,6 +371,8 @@ def create_app(lifespan_context=None):
         temp_path = os.path.join(TEMP_DIR, file_uuid)
 
         acc_sz = 0
+        hasher = hashlib.sha256()
+        head = b''
 
         try:
             async with aiofiles.open(temp_path, 'wb') as f:
@@ -102,12 +384,26 @@ def create_app(lifespan_context=None):
                     acc_sz += len(chunk)
                     if acc_sz> MAX_FILE_SIZE_BYTES:
                         raise HTTPException(status_code = 413)
+                    if not head:
+                        head = chunk
+                    hasher.update(chunk)
                     await f.write(chunk)
+            width, height = _sniff_image_size(head, mime_type)
+            meta = {
+                'size': acc_sz,
+                'mime': mime_type,
+                'sha256': hasher.digest(),
+                'width': width,
+                'height': height,
+            }
             try:
-                await _handle_upload(file_uuid)
+                await _handle_upload(file_uuid, meta, db.PRIORITIES[priority], _upload_lane(request))
             except Exception as e:
                 print(f'[API]: db err {e}')
                 return ret_err(500)
+            _controller = request.app.state.controller
+            if _controller:
+                _controller.notify_enqueued()
             return JSONResponse(content={
                         'result': '1', 
                         'file_uuid': file_uuid 
@@ -117,23 +413,172 @@ def create_app(lifespan_context=None):
                 os.remove(temp_path)
             return ret_err(e.status_code)
 
-    @app.get('/content/{file_uuid}')
+    def _content_headers(file_uuid: str, meta: dict | None) -> dict:
+        headers = {
+            'Content-Disposition': f'inline; filename="{file_uuid}"',
+            'Cache-Control': 'public, max-age=8640000',
+            'Access-Control-Allow-Origin': "*"
+        }
+        if meta:
+            if meta.get('size') is not None:
+                headers['Content-Length'] = str(meta['size'])
+            if meta.get('sha256'):
+                headers['ETag'] = f'"{meta["sha256"]}"'
+            if meta.get('parts', 1) > 1:
+                headers['Accept-Ranges'] = 'bytes'
+        return headers
+
+    def _etag_matches(if_none_match: str, etag: str | None) -> bool:
+        # RFC 9110 If-None-Match: "*" or a comma separated list, compared weakly (W/ ignored)
+        if not etag:
+            return False
+        if if_none_match.strip() == '*':
+            return True
+        opaque = etag.removeprefix('W/')
+        return any(tag.removeprefix('W/') == opaque for tag in ETAG_RE.findall(if_none_match))
+
+    def _parse_range(value: str, size: int) -> tuple[int, int]:
+        # single "bytes=a-b" | "bytes=a-" | "bytes=-n" -> inclusive (start, end). ValueError if unsatisfiable
+        unit, _, spec = value.partition('=')
+        if unit.strip() != 'bytes' or ',' in spec:
+            raise ValueError(value)
+        first, _, last = spec.strip().partition('-')
+        if first:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+        else:
+            start, end = max(0, size - int(last)), size - 1
+        if start > end or start >= size:
+            raise ValueError(value)
+        return start, end
+
+    async def _multipart_response(_controller, file_uuid: str, meta: dict, request: Request):
+        size = meta['size']
+        headers = _content_headers(file_uuid, meta)
+        status_code, start, end = 200, 0, size - 1
+
+        range_header = request.headers.get('range')
+        if range_header:
+            try:
+                start, end = _parse_range(range_header, size)
+            except ValueError:
+                return Response(status_code=416, headers={'Content-Range': f'bytes */{size}'})
+            status_code = 206
+            headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+            headers['Content-Length'] = str(end - start + 1)
+
+        try:
+            with tracing.span("get_parts"):
+                parts = await _controller.get_parts(file_uuid)
+        except httpx.HTTPError as e:
+            print(f"Request error to upstream: {e}")
+            parts = None
+        if not parts:
+            return JSONResponse(status_code=502, content={"detail": "Could not resolve file parts."})
+
+        trace = tracing.current()
+        started, sent = time.time_ns(), 0
+
+        async def finish():
+            # generator finally and response close both land here; end_trace is idempotent
+            if trace and not trace.root.end_ns:
+                trace.record("stream", started, time.time_ns(), bytes=sent, parts=len(parts))
+                tracing.end_trace(trace, status=status_code)
+
+        async def content_generator():
+            nonlocal sent
+            try:
+                async for chunk in _controller.iter_parts(parts, start, end):
+                    sent += len(chunk)
+                    yield chunk
+            except Exception as e:
+                print(f"Multipart stream error ({file_uuid}): {e}")
+            finally:
+                await finish()
+
+        return _ClosingStreamingResponse(
+            content_generator(),
+            status_code=status_code,
+            headers=headers,
+            media_type=meta['mime'],
+            on_close=finish
+        )
+
+    async def _local_response(_controller, file_uuid: str, path: str, meta: dict):
+        # local bot api server: the file is on our disk -> sendfile, no proxying
+        if not os.path.isfile(path):
+            print(f"[API]: local file missing for {file_uuid}: {path}")
+            return JSONResponse(status_code=502, content={"detail": "Upstream file is not available."})
+        mime_type = meta.get('mime')
+        if not mime_type:
+            head = await asyncio.to_thread(_controller._read_range, path, 0, 64)
+            mime_type = _sniff_image_mime(head)
+        headers = _content_headers(file_uuid, meta)
+        headers.pop('Content-Length', None) # FileResponse stats the file
+        return FileResponse(path, headers=headers, media_type=mime_type)
+
+    @app.api_route('/content/{file_uuid}', methods=['GET', 'HEAD'])
     async def content(file_uuid: str, request: Request):
+        trace = tracing.start_trace("content", file_uuid=file_uuid, method=request.method)
+        try:
+            response = await _content(file_uuid, request)
+        except BaseException:
+            tracing.end_trace(trace, status=500)
+            raise
+        # streamed bodies end their trace when the stream finishes
+        if not isinstance(response, StreamingResponse):
+            tracing.end_trace(trace, status=response.status_code)
+        return response
+
+    async def _content(file_uuid: str, request: Request, allow_variants: bool = True):
         _controller = request.app.state.controller
         if not _controller:
             return JSONResponse(status_code=503, content={"detail": "Controller not available."})
 
-        target = await _controller.get_cache(file_uuid)
-        if target is None:
-            return JSONResponse(
-                status_code=404,
-                content={"detail": "File not found. It may be in processing or the UUID is invalid."}
-            )
+        if allow_variants:
+            q = request.query_params
+            try:
+                params = variants.parse_params(q.get('w'), q.get('h'), q.get('fmt'))
+            except ValueError as e:
+                return JSONResponse(status_code=400, content={"detail": str(e)})
+            if params:
+                return await _variant_response(file_uuid, params, request)
+
+        not_found = JSONResponse(
+            status_code=404,
+            content={"detail": "File not found. It may be in processing or the UUID is invalid."}
+        )
+
+        # HEAD / conditional GET: answered from the index, no upstream
+        if_none_match = request.headers.get('if-none-match')
+        if request.method == 'HEAD' or if_none_match:
+            with tracing.span("get_meta"):
+                meta = await _controller.get_meta(file_uuid)
+            if meta is None:
+                return not_found
+            headers = _content_headers(file_uuid, meta)
+            if if_none_match and _etag_matches(if_none_match, headers.get('ETag')):
+                headers.pop('Content-Length', None)
+                return Response(status_code=304, headers=headers)
+            if request.method == 'HEAD' and meta.get('mime'):
+                return Response(status_code=200, headers=headers, media_type=meta['mime'])
+            # legacy rows w/o metadata -> fall through to the upstream sniff
+
+        with tracing.span("get_cache"):
+            cached = await _controller.get_cache(file_uuid)
+        if cached is None:
+            return not_found
+        target, meta = cached
+
+        if meta.get('parts', 1) > 1:
+            return await _multipart_response(_controller, file_uuid, meta, request)
+
+        if _controller.is_local(target):
+            return await _local_response(_controller, file_uuid, target, meta)
 
-        client: httpx.AsyncClient = request.app.state.http_client
-        req = client.build_request("GET", target)
         try:
-            upstream_response = await client.send(req, stream=True)
+            with tracing.span("upstream_open"):
+                upstream_response = await _controller.open_upstream(file_uuid, target)
         except httpx.RequestError as e:
             print(f"Request error to upstream: {e}")
             return JSONResponse(status_code=504, content={"detail": "Could not connect to upstream server."})
@@ -144,37 +589,56 @@ def create_app(lifespan_context=None):
                 content={"detail": "Upstream server returned an error."}
             )
 
-        byte_iterator = upstream_response.aiter_bytes()
-        
-        try:
-            first_chunk = await byte_iterator.__anext__()
-        except StopAsyncIteration:
-            first_chunk = b''
+        # raw = no decode pass (the download pool asks for identity); large reads = fewer hops per byte.
+        # each chunk is awaited by the server's send(), so a slow client throttles the upstream read
+        byte_iterator = upstream_response.aiter_raw(_controller.read_size)
+        headers = _content_headers(file_uuid, meta)
+        mime_type = meta.get('mime')
+        first_chunk = b''
+
+        if not mime_type:
+            try:
+                with tracing.span("first_chunk"):
+                    first_chunk = await byte_iterator.__anext__()
+            except StopAsyncIteration:
+                await upstream_response.aclose()
+                return JSONResponse(status_code=204, content={})
+            mime_type = _sniff_image_mime(first_chunk)
+            if 'content-length' in upstream_response.headers:
+                headers['Content-Length'] = upstream_response.headers['content-length']
+
+        if request.method == 'HEAD':
+            await upstream_response.aclose()
+            return Response(status_code=200, headers=headers, media_type=mime_type)
+
+        trace = tracing.current()
+        started, sent = time.time_ns(), len(first_chunk)
+
+        async def finish():
+            # generator finally and response close both land here (aclose / end_trace are idempotent)
             await upstream_response.aclose()
-            return JSONResponse(status_code=204, content={})
-        
-        mime_type = _sniff_image_mime(first_chunk)
+            if trace and not trace.root.end_ns:
+                trace.record("stream", started, time.time_ns(), bytes=sent)
+                tracing.end_trace(trace, status=200)
 
         async def content_generator():
+            nonlocal sent
             try:
-                yield first_chunk
+                if first_chunk:
+                    yield first_chunk
                 async for chunk in byte_iterator:
+                    sent += len(chunk)
                     yield chunk
             except Exception as e:
                 pass
             finally:
-                await upstream_response.aclose()
-
-        headers = {
-            'Content-Disposition': f'inline; filename="{file_uuid}"',
-            'Cache-Control': 'public, max-age=8640000',
-            'Access-Control-Allow-Origin': "*"
-        }
+                await finish()
 
-        return StreamingResponse(
+        return _ClosingStreamingResponse(
             content_generator(), 
             headers=headers, 
-            media_type=mime_type
+            media_type=mime_type,
+            on_close=finish
         )
 
     return app
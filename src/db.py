@@ -5,6 +5,7 @@ import aiomysql
 import asyncio
 from datetime import datetime
 import pymysql.converters
+from uuid_extensions import uuid7
 
 user = os.getenv("DB_USER", "tg_cdn_db_user")
 pwd = os.getenv("DB_PASSWORD", "password")
@@ -57,12 +58,30 @@ CREATE TABLE IF NOT EXISTS files (
     file_id VARCHAR(191) NOT NULL,
     msg_id INT NOT NULL,
     bot_id SMALLINT NOT NULL,
+    chat_id BIGINT NULL,
+    part_count SMALLINT NOT NULL DEFAULT 1,
+    file_size INT UNSIGNED NULL,
+    mime_type VARCHAR(32) NULL,
+    sha256 BINARY(32) NULL,
+    width INT UNSIGNED NULL,
+    height INT UNSIGNED NULL,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     
-    FOREIGN KEY (bot_id) REFERENCES bots(bot_id)
+    FOREIGN KEY (bot_id) REFERENCES bots(bot_id),
+    INDEX idx_created (created_at)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
 """
 
+# bot api getFile only serves files up to 20 MB -> bigger uploads are stored as parts
+# (a local bot api server lifts the limit to 2000 MB -> PART_SIZE_MB can go up)
+CLOUD_PART_LIMIT_BYTES = 20 * 1000 * 1000
+PART_SIZE_BYTES = int(os.getenv("PART_SIZE_MB", 20)) * 1000 * 1000
+
+# queues.priority: lower is claimed first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+PRIORITIES = {'interactive': PRIORITY_INTERACTIVE, 'bulk': PRIORITY_BULK}
+
 SQL_CREATE_QUEUES = """
 CREATE TABLE IF NOT EXISTS queues (
     file_uuid BINARY(16) PRIMARY KEY,
@@ -70,7 +89,16 @@ CREATE TABLE IF NOT EXISTS queues (
     state SMALLINT NOT NULL DEFAULT 0,
     msg_id INT NULL,
     bot_id SMALLINT NULL,
+    chat_id BIGINT NULL,
+    part_count SMALLINT NOT NULL DEFAULT 1,
     retry_count SMALLINT NOT NULL DEFAULT 0,
+    file_size INT UNSIGNED NULL,
+    mime_type VARCHAR(32) NULL,
+    sha256 BINARY(32) NULL,
+    width INT UNSIGNED NULL,
+    height INT UNSIGNED NULL,
+    priority TINYINT NOT NULL DEFAULT 0,
+    lane VARCHAR(64) NOT NULL DEFAULT '',
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP NULL ON UPDATE CURRENT_TIMESTAMP,
     available_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
@@ -78,7 +106,9 @@ CREATE TABLE IF NOT EXISTS queues (
     FOREIGN KEY (bot_id) REFERENCES bots(bot_id),
     INDEX idx_state (state),
     INDEX idx_upd (updated_at),
-    INDEX idx_avl (available_at)
+    INDEX idx_avl (available_at),
+    INDEX idx_claim_ready (state, priority, lane, created_at, available_at),
+    INDEX idx_ready (state, priority, created_at, available_at)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
 """
 
@@ -93,6 +123,66 @@ CREATE TABLE IF NOT EXISTS url_caches (
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
 """
 
+# extra copies of a file uploaded through other bots/chats (files row = primary)
+SQL_CREATE_REPLICAS = """
+CREATE TABLE IF NOT EXISTS replicas (
+    file_uuid BINARY(16) NOT NULL,
+    bot_id SMALLINT NOT NULL,
+    file_id VARCHAR(191) NOT NULL,
+    msg_id INT NOT NULL,
+    chat_id BIGINT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+
+    PRIMARY KEY (file_uuid, bot_id),
+    FOREIGN KEY (file_uuid) REFERENCES files(file_uuid) ON DELETE CASCADE,
+    FOREIGN KEY (bot_id) REFERENCES bots(bot_id)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+"""
+
+# files with part_count > 1: one row per <= PART_SIZE_BYTES slice (files row = part 0).
+# written before the files row exists (state 30), hence no fk on file_uuid
+SQL_CREATE_PARTS = """
+CREATE TABLE IF NOT EXISTS parts (
+    file_uuid BINARY(16) NOT NULL,
+    part_no SMALLINT NOT NULL,
+    part_offset INT UNSIGNED NOT NULL,
+    part_size INT UNSIGNED NOT NULL,
+    bot_id SMALLINT NOT NULL,
+    file_id VARCHAR(191) NOT NULL,
+    msg_id INT NOT NULL,
+    chat_id BIGINT NOT NULL,
+
+    PRIMARY KEY (file_uuid, part_no),
+    FOREIGN KEY (bot_id) REFERENCES bots(bot_id)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+"""
+
+# decayed access counts of the hottest files, for cache warming after restarts.
+# updated_at = last persisted batch the file was in (set explicitly: no ON UPDATE, the decay must not move it)
+SQL_CREATE_HOT_FILES = """
+CREATE TABLE IF NOT EXISTS hot_files (
+    file_uuid BINARY(16) PRIMARY KEY,
+    hits INT UNSIGNED NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+
+    FOREIGN KEY (file_uuid) REFERENCES files(file_uuid) ON DELETE CASCADE,
+    INDEX idx_hits (hits)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+"""
+
+# derivative (resize / re-encode) of a file, stored as its own file
+SQL_CREATE_VARIANTS = """
+CREATE TABLE IF NOT EXISTS variants (
+    file_uuid BINARY(16) NOT NULL,
+    params VARCHAR(32) NOT NULL,
+    variant_uuid BINARY(16) NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+
+    PRIMARY KEY (file_uuid, params),
+    FOREIGN KEY (file_uuid) REFERENCES files(file_uuid) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+"""
+
 SQL_CREATE_GC_RUNS = """
 CREATE TABLE IF NOT EXISTS gc_runs (
     run_id INT AUTO_INCREMENT PRIMARY KEY,
@@ -105,6 +195,29 @@ CREATE TABLE IF NOT EXISTS gc_runs (
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
 """
 
+# tables created before the columns below existed
+SQL_MIGRATIONS = [
+    f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column}"
+    for table in ("files", "queues")
+    for column in (
+        "file_size INT UNSIGNED NULL",
+        "mime_type VARCHAR(32) NULL",
+        "sha256 BINARY(32) NULL",
+        "width INT UNSIGNED NULL",
+        "height INT UNSIGNED NULL",
+        "chat_id BIGINT NULL",
+        "part_count SMALLINT NOT NULL DEFAULT 1",
+    )
+] + [
+    "ALTER TABLE queues ADD COLUMN IF NOT EXISTS priority TINYINT NOT NULL DEFAULT 0",
+    "ALTER TABLE queues ADD COLUMN IF NOT EXISTS lane VARCHAR(64) NOT NULL DEFAULT ''",
+    # available_at is in the claim indexes so the ready filter never needs the row
+    "CREATE INDEX IF NOT EXISTS idx_claim_ready ON queues (state, priority, lane, created_at, available_at)",
+    "CREATE INDEX IF NOT EXISTS idx_ready ON queues (state, priority, created_at, available_at)",
+    "DROP INDEX IF EXISTS idx_claim ON queues",
+    "CREATE INDEX IF NOT EXISTS idx_created ON files (created_at)",
+    "ALTER TABLE hot_files MODIFY updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP",
+]
 
 async def init_models():
     global pool
@@ -118,7 +231,13 @@ async def init_models():
             await cursor.execute(SQL_CREATE_FILES)
             await cursor.execute(SQL_CREATE_QUEUES)
             await cursor.execute(SQL_CREATE_URL_CACHES)
+            await cursor.execute(SQL_CREATE_REPLICAS)
+            await cursor.execute(SQL_CREATE_PARTS)
+            await cursor.execute(SQL_CREATE_HOT_FILES)
+            await cursor.execute(SQL_CREATE_VARIANTS)
             await cursor.execute(SQL_CREATE_GC_RUNS)
+            for migration in SQL_MIGRATIONS:
+                await cursor.execute(migration)
 
 def _bin_to_uuid_str(value: bytes | None) -> str | None:
     """ DB (bytes) -> Python (str) """
@@ -129,24 +248,40 @@ def _bin_to_uuid_str(value: bytes | None) -> str | None:
     except ValueError:
         return None
 
+def parse_uuid(value: str | uuid.UUID) -> uuid.UUID | None:
+    """ 36 / 32 char str or UUID -> UUID, None if malformed. callers parse once and pass the UUID on """
+    if isinstance(value, uuid.UUID):
+        return value
+    if not isinstance(value, str) or len(value) not in (32, 36):
+        return None
+    try:
+        return uuid.UUID(value)
+    except ValueError:
+        return None
+
+def uuid7_floor(ns: int) -> bytes:
+    """
+    lowest uuid (bytes) uuid_extensions.uuid7 can produce at ns. its first 8 bytes are
+    seconds / fraction / version, so raw bytes compare in time order (not unix ms!)
+    """
+    return uuid7(ns=ns, as_type='bytes')[:8] + bytes(8)
+
+def row_to_meta(row: dict) -> dict:
+    """ files/queues row -> metadata dict (None if unknown, e.g. legacy rows) """
+    sha256 = row.get('sha256')
+    return {
+        'size': row.get('file_size'),
+        'mime': row.get('mime_type'),
+        'sha256': sha256.hex() if sha256 else None,
+        'width': row.get('width'),
+        'height': row.get('height'),
+        'parts': row.get('part_count') or 1,
+    }
+
 class FilesRepository:
     async def get_file_by_uuid(self, file_uuid: str | uuid.UUID) -> dict | None:
-        file_uuid_obj: uuid.UUID | None = None
-
-        try:
-            if isinstance(file_uuid, str):
-                if len(file_uuid) == 36: 
-                    file_uuid_obj = uuid.UUID(file_uuid)
-                elif len(file_uuid) == 32: 
-                    file_uuid_obj = uuid.UUID(hex=file_uuid)
-                else:
-                    return None
-            elif isinstance(file_uuid, uuid.UUID):
-                file_uuid_obj = file_uuid
-            else:
-                return None
-                
-        except ValueError:
+        file_uuid_obj = parse_uuid(file_uuid)
+        if file_uuid_obj is None:
             return None
 
         file_uuid_bytes = file_uuid_obj.bytes
@@ -167,22 +302,8 @@ class FilesRepository:
 
 class UrlCacheRepository:
     async def get_url_cache_by_uuid(self, file_uuid: str | uuid.UUID) -> dict | None:
-        file_uuid_obj: uuid.UUID | None = None
-
-        try:
-            if isinstance(file_uuid, str):
-                if len(file_uuid) == 36: 
-                    file_uuid_obj = uuid.UUID(file_uuid)
-                elif len(file_uuid) == 32: 
-                    file_uuid_obj = uuid.UUID(hex=file_uuid)
-                else:
-                    return None
-            elif isinstance(file_uuid, uuid.UUID):
-                file_uuid_obj = file_uuid
-            else:
-                return None
-                
-        except ValueError:
+        file_uuid_obj = parse_uuid(file_uuid)
+        if file_uuid_obj is None:
             return None
 
         file_uuid_bytes = file_uuid_obj.bytes
@@ -191,29 +312,20 @@ class UrlCacheRepository:
         async with pool.acquire() as conn:
             async with conn.cursor(aiomysql.DictCursor) as cursor:
                 await cursor.execute(
-                    "SELECT file_id, bot_token FROM url_caches WHERE file_uuid = %s",
+                    """
+                    SELECT u.file_id, u.bot_token, f.file_size, f.mime_type, f.sha256, f.width, f.height, f.part_count
+                    FROM url_caches u
+                    JOIN files f ON f.file_uuid = u.file_uuid
+                    WHERE u.file_uuid = %s
+                    """,
                     (file_uuid_bytes,)
                 )
                 row = await cursor.fetchone()
                 return row
 
     async def insert_url_cache(self, file_uuid: str | uuid.UUID, file_id: str, bot_token: str) -> int:
-        file_uuid_obj: uuid.UUID | None = None
-
-        try:
-            if isinstance(file_uuid, str):
-                if len(file_uuid) == 36: 
-                    file_uuid_obj = uuid.UUID(file_uuid)
-                elif len(file_uuid) == 32: 
-                    file_uuid_obj = uuid.UUID(hex=file_uuid)
-                else:
-                    return 0
-            elif isinstance(file_uuid, uuid.UUID):
-                file_uuid_obj = file_uuid
-            else:
-                return 0
-                
-        except ValueError:
+        file_uuid_obj = parse_uuid(file_uuid)
+        if file_uuid_obj is None:
             return 0
 
         file_uuid_bytes = file_uuid_obj.bytes
@@ -0,0 +1,409 @@
+"""
+bulk index tool (run next to the app, same .env):
+
+    python -m src.index_cli export  --out index.ndjson.gz
+    python -m src.index_cli import  --in index.ndjson.gz [--load-data]
+    python -m src.index_cli backfill [--chat-id -100... ...] --scratch-chat-id -100... [--from 1] [--to N] [--no-download]
+
+dump = one json object per line, {"table": ..., <columns>}; binary columns hex encoded.
+tables go out in fk order (bots -> files -> parts), so a dump can be loaded as a stream.
+
+imported rows keep their original created_at, so running servers don't pick them up in their
+bloom filter sync (it follows created_at): restart them after an import. backfilled rows are new
+rows and are picked up within a minute.
+
+backfill talks to TELEGRAM_API_URL like the app (with TELEGRAM_API_LOCAL=1, run it where the
+server's working dir is mounted). it scans every storage chat (default: all of SENDBOT_CHAT_ID)
+in one run: the parts of a file are spread over the chats. extra copies of a file
+(REPLICATION_FACTOR) go to replicas. it downloads every file once to restore sha256 / width /
+height (ETag, HEAD, derivatives); with --no-download they stay NULL and /content falls back to
+sniffing the upstream.
+"""
+import argparse
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import uuid
+from datetime import datetime
+from io import BytesIO
+import aiomysql
+from . import db
+
+EXPORT_TABLES = ("bots", "files", "parts")
+BINARY_COLUMNS = {"file_uuid", "sha256"}
+KEYSET = {"bots": ("bot_id",), "files": ("file_uuid",), "parts": ("file_uuid", "part_no")}
+EXPORT_BATCH = 10000
+IMPORT_BATCH = 5000
+
+def _open(path: str, mode: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+def _encode(row: dict) -> dict:
+    out = {}
+    for k, v in row.items():
+        if isinstance(v, (bytes, bytearray)):
+            v = v.hex()
+        elif isinstance(v, datetime):
+            v = v.strftime("%Y-%m-%d %H:%M:%S")
+        out[k] = v
+    return out
+
+def _decode(row: dict) -> dict:
+    return {k: bytes.fromhex(v) if k in BINARY_COLUMNS and v is not None else v for k, v in row.items()}
+
+# export
+
+async def export(path: str, tables: tuple[str, ...]):
+    total = 0
+    with _open(path, "w") as f:
+        for table in tables:
+            keys = KEYSET[table]
+            last = None
+            while True:
+                # keyset pagination, never OFFSET
+                where, params = "", ()
+                if last is not None:
+                    where = f"WHERE ({', '.join(keys)}) > ({', '.join(['%s'] * len(keys))})"
+                    params = tuple(last[k] for k in keys)
+                async with db.pool.acquire() as conn:
+                    async with conn.cursor(aiomysql.DictCursor) as cursor:
+                        await cursor.execute(
+                            f"SELECT * FROM {table} {where} ORDER BY {', '.join(keys)} LIMIT %s",
+                            params + (EXPORT_BATCH,)
+                        )
+                        rows = await cursor.fetchall()
+                if not rows:
+                    break
+                f.write("".join(json.dumps({"table": table, **_encode(r)}) + "\n" for r in rows))
+                total += len(rows)
+                last = rows[-1]
+            print(f"[index_cli] exported {table} (running total {total})")
+    print(f"[index_cli] export done: {total} rows -> {path}")
+
+# import
+
+async def _insert_rows(cursor, table: str, cols: tuple[str, ...], rows: list[tuple]):
+    # executemany on INSERT ... VALUES is sent as one multi-row statement
+    await cursor.executemany(
+        f"INSERT IGNORE INTO {table} ({', '.join(cols)}) VALUES ({', '.join(['%s'] * len(cols))})",
+        rows
+    )
+
+async def import_dump(path: str):
+    total = 0
+    async with db.pool.acquire() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute("SET SESSION foreign_key_checks = 0")
+            try:
+                key, buf = None, []
+                with _open(path, "r") as f:
+                    for line in f:
+                        if not line.strip():
+                            continue
+                        row = json.loads(line)
+                        table = row.pop("table")
+                        row = _decode(row)
+                        cols = tuple(row)
+                        if (table, cols) != key and buf:
+                            await _insert_rows(cursor, *key, buf)
+                            total += len(buf)
+                            buf = []
+                        key = (table, cols)
+                        buf.append(tuple(row.values()))
+                        if len(buf) >= IMPORT_BATCH:
+                            await _insert_rows(cursor, *key, buf)
+                            total += len(buf)
+                            buf = []
+                            if total // IMPORT_BATCH % 20 == 0:
+                                print(f"[index_cli] imported {total} rows")
+                if buf:
+                    await _insert_rows(cursor, *key, buf)
+                    total += len(buf)
+                await conn.commit()
+            finally:
+                await cursor.execute("SET SESSION foreign_key_checks = 1")
+    print(f"[index_cli] import done: {total} rows (restart running servers to reload their bloom filter)")
+
+def _tsv(v) -> str:
+    if v is None:
+        return "\\N"
+    if isinstance(v, (bytes, bytearray)):
+        return v.hex()
+    return str(v).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+
+async def import_load_data(path: str):
+    """
+    LOAD DATA LOCAL INFILE per table (fastest for multi-million row restores).
+    needs local_infile enabled on the server; binary columns go through UNHEX.
+    """
+    spools: dict[str, tuple[tuple[str, ...], object]] = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        with _open(path, "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                row = json.loads(line)
+                table = row.pop("table")
+                if table not in spools:
+                    spools[table] = (tuple(row), open(os.path.join(tmp, f"{table}.tsv"), "w", encoding="utf-8"))
+                cols, out = spools[table]
+                out.write("\t".join(_tsv(row.get(c)) for c in cols) + "\n")
+        for _, out in spools.values():
+            out.close()
+
+        conn = await aiomysql.connect(
+            host=db.host, port=db.port, user=db.user, password=db.pwd, db=db.db,
+            charset="utf8mb4", local_infile=True, autocommit=False,
+        )
+        try:
+            async with conn.cursor() as cursor:
+                await cursor.execute("SET SESSION foreign_key_checks = 0")
+                for table in [t for t in EXPORT_TABLES if t in spools]:
+                    cols, out = spools[table]
+                    targets = [f"@{c}" if c in BINARY_COLUMNS else c for c in cols]
+                    sets = [f"{c} = UNHEX(@{c})" for c in cols if c in BINARY_COLUMNS]
+                    await cursor.execute(
+                        f"LOAD DATA LOCAL INFILE %s IGNORE INTO TABLE {table} "
+                        f"FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '\\n' ({', '.join(targets)})"
+                        + (f" SET {', '.join(sets)}" if sets else ""),
+                        (out.name,)
+                    )
+                    print(f"[index_cli] loaded {cursor.rowcount} rows into {table}")
+                await cursor.execute("SET SESSION foreign_key_checks = 1")
+            await conn.commit()
+        finally:
+            conn.close()
+    print("[index_cli] load done (restart running servers to reload their bloom filter)")
+
+# backfill
+
+def _image_size(data: bytes) -> tuple[int | None, int | None]:
+    from PIL import Image
+
+    try:
+        with Image.open(BytesIO(data)) as img:
+            return img.size
+    except Exception:
+        return None, None
+
+def _parse_caption(caption: str | None) -> tuple[bytes, int, int] | None:
+    # "<uuid>" or "<uuid> <i>/<n>" (parts, see Tgbot._send_parts) -> (uuid bytes, part_no, part_count)
+    if not caption:
+        return None
+    head, _, tail = caption.strip().partition(" ")
+    try:
+        file_uuid = uuid.UUID(head).bytes
+        if not tail:
+            return file_uuid, 0, 1
+        i, n = tail.split("/")
+        return file_uuid, int(i) - 1, int(n)
+    except ValueError:
+        return None
+
+async def backfill(tokens: list[str], chat_ids: list[int], scratch_chat_id: int, start: int, end: int | None, max_gap: int,
+                   download: bool = True, api_url: str | None = None, local_mode: bool = False):
+    """
+    rebuild files/parts/replicas from the storage chats. the bot api has no history read, so every
+    message id is forwarded to a scratch chat (read caption + file_id, then deleted).
+    chats are scanned one after another, ids striped over all bots; throughput is bounded by
+    telegram's per-chat limits. parts are collected across chats, each with the chat it is in.
+    api_url / local_mode: same bot api server as the app (Tgbot.build); bots logged out of the cloud
+    only answer there, and parts over 20 MB can only be downloaded from a local one.
+    with download, each file is fetched once (part by part, through the bot that saw it) for
+    sha256 / width / height.
+    """
+    from telegram import Bot
+    from telegram.error import BadRequest, RetryAfter
+    from .main import get_or_create_bot
+
+    bot_records = [await get_or_create_bot(t) for t in tokens]
+    server = {}
+    if api_url:
+        api_url = api_url.rstrip("/")
+        server = {"base_url": f"{api_url}/bot", "base_file_url": f"{api_url}/file/bot", "local_mode": local_mode}
+    bots = [Bot(r["bot_token"], **server) for r in bot_records]
+    for b in bots:
+        await b.initialize()
+    bots_by_id = {r["bot_id"]: b for b, r in zip(bots, bot_records)}
+
+    files_rows, parts_rows, replica_rows = [], [], []
+    # file_uuid -> {part_no: (msg_id, bot_id, file_id, size, mime, chat_id)}, shared by all chats
+    pending_parts: dict[bytes, dict[int, tuple]] = {}
+    # files that already have their files row (later copies are replicas)
+    indexed: set[bytes] = set()
+    state = {"chat_id": chat_ids[0], "next": start, "last_hit": start, "seen": 0}
+
+    async def flush():
+        # take the rows first: other workers keep appending while we await
+        f_rows, p_rows, r_rows = files_rows[:], parts_rows[:], replica_rows[:]
+        files_rows.clear()
+        parts_rows.clear()
+        replica_rows.clear()
+        async with db.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                if f_rows:
+                    await _insert_rows(cursor, "files",
+                                       ("file_uuid", "file_id", "msg_id", "bot_id", "chat_id", "part_count", "file_size", "mime_type",
+                                        "sha256", "width", "height"),
+                                       f_rows)
+                if p_rows:
+                    await _insert_rows(cursor, "parts",
+                                       ("file_uuid", "part_no", "part_offset", "part_size", "bot_id", "file_id", "msg_id", "chat_id"),
+                                       p_rows)
+                if r_rows:
+                    await _insert_rows(cursor, "replicas", ("file_uuid", "bot_id", "file_id", "msg_id", "chat_id"), r_rows)
+                await conn.commit()
+        print(f"[index_cli] backfill: +{len(f_rows)} files, +{len(p_rows)} parts, +{len(r_rows)} replicas "
+              f"(chat {state['chat_id']}, msg_id {state['next']})")
+
+    async def describe(pieces: list[tuple[int, str]], mime: str | None) -> tuple:
+        # [(bot_id, file_id)] in part order -> (sha256, width, height); NULLs if a download fails
+        if not download:
+            return None, None, None
+        hasher = hashlib.sha256()
+        head = None
+        try:
+            for bot_id, file_id in pieces:
+                tg_file = await bots_by_id[bot_id].get_file(file_id)
+                data = await tg_file.download_as_bytearray()
+                hasher.update(data)
+                if head is None:
+                    head = bytes(data)
+        except Exception as e:
+            print(f"[index_cli] download failed ({e}), sha256 / width / height left NULL")
+            return None, None, None
+        width, height = None, None
+        if mime and mime.startswith("image/"):
+            width, height = await asyncio.to_thread(_image_size, head)
+        return hasher.digest(), width, height
+
+    async def on_document(chat_id: int, msg_id: int, bot_id: int, parsed: tuple, doc):
+        file_uuid, part_no, part_count = parsed
+        if part_count == 1:
+            if file_uuid in indexed:
+                replica_rows.append((file_uuid, bot_id, doc.file_id, msg_id, chat_id))
+                return
+            indexed.add(file_uuid)
+            sha256, width, height = await describe([(bot_id, doc.file_id)], doc.mime_type)
+            files_rows.append((file_uuid, doc.file_id, msg_id, bot_id, chat_id, 1, doc.file_size, doc.mime_type,
+                               sha256, width, height))
+            return
+        if file_uuid in indexed:
+            return # re-sent part of a retried upload
+        got = pending_parts.setdefault(file_uuid, {})
+        got[part_no] = (msg_id, bot_id, doc.file_id, doc.file_size or 0, doc.mime_type, chat_id)
+        if len(got) < part_count:
+            return
+        # all parts seen -> offsets from the sizes, part 0 becomes the files row
+        del pending_parts[file_uuid]
+        indexed.add(file_uuid)
+        offset = 0
+        for no in range(part_count):
+            p_msg, p_bot, p_fid, p_size, _, p_chat = got[no]
+            parts_rows.append((file_uuid, no, offset, p_size, p_bot, p_fid, p_msg, p_chat))
+            offset += p_size
+        p_msg, p_bot, p_fid, _, p_mime, p_chat = got[0]
+        sha256, width, height = await describe([(got[no][1], got[no][2]) for no in range(part_count)], p_mime)
+        files_rows.append((file_uuid, p_fid, p_msg, p_bot, p_chat, part_count, offset, p_mime, sha256, width, height))
+
+    async def worker(bot: Bot, bot_id: int):
+        chat_id = state["chat_id"]
+        while True:
+            msg_id = state["next"]
+            if (end is not None and msg_id > end) or msg_id - state["last_hit"] > max_gap:
+                return
+            state["next"] += 1
+            for _ in range(5):
+                try:
+                    fwd = await bot.forward_message(chat_id=scratch_chat_id, from_chat_id=chat_id, message_id=msg_id)
+                    break
+                except RetryAfter as e:
+                    await asyncio.sleep(float(e.retry_after))
+                except BadRequest:
+                    fwd = None # deleted / service message
+                    break
+            else:
+                print(f"[index_cli] gave up on msg_id {msg_id}")
+                continue
+            if fwd is None:
+                continue
+            state["last_hit"] = max(state["last_hit"], msg_id)
+            parsed = _parse_caption(fwd.caption)
+            if fwd.document and parsed:
+                await on_document(chat_id, msg_id, bot_id, parsed, fwd.document)
+                state["seen"] += 1
+            try:
+                await bot.delete_message(chat_id=scratch_chat_id, message_id=fwd.message_id)
+            except Exception:
+                pass
+            if len(files_rows) + len(parts_rows) >= IMPORT_BATCH:
+                await flush()
+
+    try:
+        for chat_id in chat_ids:
+            state.update(chat_id=chat_id, next=start, last_hit=start)
+            await asyncio.gather(*(worker(b, r["bot_id"]) for b, r in zip(bots, bot_records)))
+            print(f"[index_cli] chat {chat_id}: stopped at msg_id {state['next'] - 1}")
+        await flush()
+    finally:
+        for b in bots:
+            await b.shutdown()
+    if pending_parts:
+        print(f"[index_cli] {len(pending_parts)} multipart files were missing parts and were skipped")
+    print(f"[index_cli] backfill done: {state['seen']} documents in {len(chat_ids)} chats")
+
+async def _run(args):
+    await db.init_db_pool()
+    try:
+        if args.cmd == "export":
+            await export(args.out, tuple(args.tables.split(",")))
+        elif args.cmd == "import":
+            if args.load_data:
+                await import_load_data(args.input)
+            else:
+                await import_dump(args.input)
+        elif args.cmd == "backfill":
+            tokens = [t.strip() for t in (args.tokens or os.getenv("SENDBOT_TOKENS", "")).split(",") if t.strip()]
+            if not tokens:
+                raise SystemExit("no bot tokens (SENDBOT_TOKENS or --tokens)")
+            chat_ids = args.chat_id or [int(c) for c in os.getenv("SENDBOT_CHAT_ID", "").split(",") if c.strip()]
+            if not chat_ids:
+                raise SystemExit("no storage chats (SENDBOT_CHAT_ID or --chat-id)")
+            await backfill(tokens, chat_ids, args.scratch_chat_id, args.start, args.end, args.max_gap,
+                           download=not args.no_download,
+                           api_url=os.getenv("TELEGRAM_API_URL") or None,
+                           local_mode=os.getenv("TELEGRAM_API_LOCAL", "0") == "1")
+    finally:
+        await db.close_db_pool()
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m src.index_cli", description="tg_cdn index import / export / backfill")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("export", help="stream bots/files/parts to ndjson (.gz ok)")
+    p.add_argument("--out", required=True)
+    p.add_argument("--tables", default=",".join(EXPORT_TABLES))
+
+    p = sub.add_parser("import", help="load an export (multi-row INSERT IGNORE, or LOAD DATA)")
+    p.add_argument("--in", dest="input", required=True)
+    p.add_argument("--load-data", action="store_true", help="use LOAD DATA LOCAL INFILE (server needs local_infile)")
+
+    p = sub.add_parser("backfill", help="rebuild files/parts from the storage channel captions")
+    p.add_argument("--chat-id", type=int, action="append", default=None,
+                   help="storage chat, repeatable; default every SENDBOT_CHAT_ID (parts are spread over all of them)")
+    p.add_argument("--scratch-chat-id", type=int, required=True, help="chat the bots may forward into (and delete from)")
+    p.add_argument("--from", dest="start", type=int, default=1)
+    p.add_argument("--to", dest="end", type=int, default=None)
+    p.add_argument("--max-gap", type=int, default=1000, help="stop after this many ids without a message")
+    p.add_argument("--tokens", default=None, help="comma separated, default SENDBOT_TOKENS")
+    p.add_argument("--no-download", action="store_true", help="skip fetching the files: sha256 / width / height stay NULL")
+
+    asyncio.run(_run(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
@@ -6,10 +6,13 @@ import aiomysql
 from contextlib import asynccontextmanager
 from . import Controller
 from . import SendTgbot
-from .api import create_app
+from .api import create_app, VARIANT_DIR
+from . import variants
 from . import db
+from . import tracing
 from .worker import DBWorker
 import httpx
+from concurrent.futures import ProcessPoolExecutor
 
 @asynccontextmanager
 async def lifespan(app: create_app):
@@ -21,6 +24,20 @@ async def lifespan(app: create_app):
         exit()
 
     sbot_tokens = [t.strip() for t in sbot_tokens_str.split(',')]
+    sbot_chat_ids = [int(c.strip()) for c in sbot_chat_id.split(',') if c.strip()]
+    replication_factor = int(os.getenv("REPLICATION_FACTOR", 1))
+    hedge_min_delay = int(os.getenv("HEDGE_MIN_DELAY_MS", 300)) / 1000
+    api_url = os.getenv("TELEGRAM_API_URL") or "https://api.telegram.org"
+    api_local = os.getenv("TELEGRAM_API_LOCAL", "0") == "1"
+    if db.PART_SIZE_BYTES > db.CLOUD_PART_LIMIT_BYTES and not api_local:
+        # parts over 20 MB can't be downloaded back through the cloud bot api
+        print("PART_SIZE_MB > 20 needs a local bot api server (TELEGRAM_API_LOCAL=1).")
+        exit()
+    download_max_connections = int(os.getenv("DOWNLOAD_MAX_CONNECTIONS", 200))
+    download_read_size = int(os.getenv("DOWNLOAD_READ_KB", 256)) * 1024
+    redis_url = os.getenv("REDIS_URL") or "redis://redis:6379/0"
+    redis_max_connections = int(os.getenv("REDIS_MAX_CONNECTIONS", 50))
+    redis_prefix = os.getenv("REDIS_PREFIX", "tgc:")
 
     async def bootstrap_db(max_try=20, delay=1.5):
         for i in range(max_try):
@@ -40,49 +57,136 @@ async def lifespan(app: create_app):
         print(f"CRITICAL: Failed to initialize database: {e}")
         exit()
 
+    tracing.tracer.configure(
+        sample_rate=float(os.getenv("TRACE_SAMPLE_RATE", 0)),
+        slow_ms=float(os.getenv("TRACE_SLOW_MS", 0)),
+        file_path=os.getenv("TRACE_FILE"),
+        otlp_endpoint=os.getenv("TRACE_OTLP_ENDPOINT"),
+    )
+    await tracing.tracer.start()
+
     db_worker_instance = DBWorker()
     db_worker_task = asyncio.create_task(db_worker_instance.run())
 
     bot_records = await asyncio.gather(*(get_or_create_bot(token) for token in sbot_tokens))
 
-    sbots = [SendTgbot.Tgbot(bot_id=bot['bot_id'], token=bot['bot_token'], chat_id=int(sbot_chat_id)) for bot in bot_records]
+    sbots = [
+        SendTgbot.Tgbot(bot_id=bot['bot_id'], token=bot['bot_token'], chat_ids=sbot_chat_ids, replicas=replication_factor,
+                        api_url=api_url, local_mode=api_local)
+        for bot in bot_records
+    ]
+    for b in sbots:
+        b.peers = [p for p in sbots if p is not b]
     apps = [b.build() for b in sbots]
 
     http_client = httpx.AsyncClient(
             limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
             timeout=httpx.Timeout(30.0, connect=5.0)
             )
+    # file bodies: own pool, HTTP/2 where upstream offers it, no content-encoding (bytes are passed through raw)
+    download_client = httpx.AsyncClient(
+            http2=os.getenv("DOWNLOAD_HTTP2", "1") == "1",
+            limits=httpx.Limits(max_keepalive_connections=download_max_connections // 4, max_connections=download_max_connections),
+            timeout=httpx.Timeout(30.0, connect=5.0, pool=10.0),
+            headers={"Accept-Encoding": "identity"}
+            )
 
     ctr = Controller.Con(
         sbots=sbots,
         db_queue=db_worker_instance.queue,
-        http_client=http_client
+        http_client=http_client,
+        hedge_min_delay=hedge_min_delay,
+        api_url=api_url,
+        api_local=api_local,
+        download_client=download_client,
+        download_limit=download_max_connections,
+        read_size=download_read_size,
+        redis_url=redis_url,
+        redis_max_connections=redis_max_connections,
+        redis_prefix=redis_prefix
         )
     app.state.controller = ctr
     controller_task = asyncio.create_task(ctr.task())
+    reconcile_task = asyncio.create_task(ctr.reconcile_task())
+    bloom_task = asyncio.create_task(ctr.bloom_task())
+    hot_task = asyncio.create_task(ctr.persist_hot_task())
+    pool_stats_task = asyncio.create_task(ctr.download_stats_task())
     app.state.http_client = http_client
+    # derivatives (/content?w=&h=&fmt=) render off the event loop
+    variant_pool = ProcessPoolExecutor(
+        max_workers=int(os.getenv("VARIANT_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+    )
+    app.state.variant_pool = variant_pool
+    variant_cache_bytes = int(os.getenv("VARIANT_CACHE_MB", 1024)) * 1024 * 1024
+    evict_task = asyncio.create_task(variant_evict_task(variant_cache_bytes))
 
     await asyncio.gather(*(app.initialize() for app in apps))
     await asyncio.gather(*(app.start() for app in apps))
     await asyncio.gather(*(b.start_background() for b in sbots))
+    dispatch_task = asyncio.create_task(ctr.dispatch_task())
+    # runs alongside traffic; rate-limited
+    warm_task = asyncio.create_task(ctr.warm_task())
 
     try:
         yield
     finally:
+        dispatch_task.cancel()
+        warm_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await dispatch_task
+        with contextlib.suppress(asyncio.CancelledError):
+            await warm_task
         await asyncio.gather(*(b.stop_background() for b in sbots))
+        try:
+            await ctr.release_pending()
+        except Exception as e:
+            print(f"[Controller Dispatch] release on shutdown failed: {e}")
         await asyncio.gather(*(app.stop() for app in reversed(apps)))
         await asyncio.gather(*(app.shutdown() for app in reversed(apps)))
         controller_task.cancel()
+        reconcile_task.cancel()
+        bloom_task.cancel()
+        hot_task.cancel()
+        pool_stats_task.cancel()
+        evict_task.cancel()
         with contextlib.suppress(asyncio.CancelledError):
             await controller_task
+        with contextlib.suppress(asyncio.CancelledError):
+            await reconcile_task
+        with contextlib.suppress(asyncio.CancelledError):
+            await bloom_task
+        with contextlib.suppress(asyncio.CancelledError):
+            await hot_task
+        with contextlib.suppress(asyncio.CancelledError):
+            await pool_stats_task
+        with contextlib.suppress(asyncio.CancelledError):
+            await evict_task
 
         db_worker_task.cancel()
         with contextlib.suppress(asyncio.CancelledError):
             await db_worker_task
         
+        variant_pool.shutdown(wait=False, cancel_futures=True)
+        await ctr.close()
+        await download_client.aclose()
+        await http_client.aclose()
+        await tracing.tracer.stop()
         await db.close_db_pool()
 
 
+VARIANT_EVICT_INTERVAL = 300
+
+async def variant_evict_task(max_bytes: int):
+    # derivative cache is LRU-bounded on disk (see variants.evict)
+    while True:
+        try:
+            removed, freed = await asyncio.to_thread(variants.evict, VARIANT_DIR, max_bytes)
+            if removed:
+                print(f"[Variants] evicted {removed} derivatives ({freed // (1024 * 1024)} MB)")
+        except Exception as e:
+            print(f"[Variants] eviction failed: {e}")
+        await asyncio.sleep(VARIANT_EVICT_INTERVAL)
+
 async def get_or_create_bot(token: str) -> dict:
     if not db.pool:
         raise RuntimeError("Database pool is not initialized.")
@@ -0,0 +1,208 @@
+"""
+lightweight per-request tracing.
+
+    t = tracing.start_trace("content", file_uuid=...)
+    with tracing.span("redis"):
+        ...
+    tracing.end_trace(t)
+
+spans nest via contextvars (child tasks inherit the active trace).
+finished traces are exported if sampled (TRACE_SAMPLE_RATE) or slower than TRACE_SLOW_MS
+to a ndjson file (TRACE_FILE) and/or an OTLP/HTTP json collector (TRACE_OTLP_ENDPOINT).
+slow traces are always printed.
+"""
+import asyncio
+import contextlib
+import contextvars
+import json
+import os
+import random
+import time
+import httpx
+
+_trace: contextvars.ContextVar["Trace | None"] = contextvars.ContextVar("trace", default=None)
+_parent: contextvars.ContextVar[str | None] = contextvars.ContextVar("span_parent", default=None)
+
+class Span:
+    __slots__ = ("name", "span_id", "parent_id", "start_ns", "end_ns", "attrs")
+
+    def __init__(self, name: str, parent_id: str | None, attrs: dict):
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.attrs = attrs
+
+    @property
+    def duration_ms(self) -> float:
+        return (self.end_ns - self.start_ns) / 1e6
+
+class Trace:
+    def __init__(self, name: str, sampled: bool, attrs: dict):
+        self.trace_id = os.urandom(16).hex()
+        self.sampled = sampled
+        self.root = Span(name, None, attrs)
+        self.spans: list[Span] = []
+
+    def record(self, name: str, start_ns: int, end_ns: int, **attrs):
+        # manual span, e.g. for work that outlives the handler (streamed bodies)
+        span = Span(name, self.root.span_id, attrs)
+        span.start_ns, span.end_ns = start_ns, end_ns
+        self.spans.append(span)
+
+class Tracer:
+    FLUSH_INTERVAL = 2.0
+    MAX_PENDING = 10000
+
+    def __init__(self):
+        self.sample_rate = 0.0
+        self.slow_ms = 0.0
+        self.file_path: str | None = None
+        self.otlp_endpoint: str | None = None
+        self.service_name = "tg_cdn"
+        self._pending: list[Trace] = []
+        self._task: asyncio.Task | None = None
+        self._client: httpx.AsyncClient | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0 or self.slow_ms > 0
+
+    def configure(self, sample_rate: float = 0.0, slow_ms: float = 0.0,
+                  file_path: str | None = None, otlp_endpoint: str | None = None):
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.file_path = file_path or None
+        self.otlp_endpoint = otlp_endpoint or None
+
+    async def start(self):
+        if self.otlp_endpoint:
+            self._client = httpx.AsyncClient(timeout=httpx.Timeout(5.0))
+        if self.file_path or self.otlp_endpoint:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        await self._flush()
+        if self._client:
+            await self._client.aclose()
+            self._client = None
+
+    def finish(self, trace: Trace):
+        duration_ms = trace.root.duration_ms
+        slow = self.slow_ms > 0 and duration_ms >= self.slow_ms
+        if slow:
+            steps = ", ".join(f"{s.name}={s.duration_ms:.1f}ms" for s in trace.spans)
+            print(f"[Trace] slow {trace.root.name} {duration_ms:.1f}ms {trace.root.attrs} | {steps}")
+        if (trace.sampled or slow) and (self.file_path or self.otlp_endpoint):
+            if len(self._pending) < self.MAX_PENDING:
+                self._pending.append(trace)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.FLUSH_INTERVAL)
+            try:
+                await self._flush()
+            except Exception as e:
+                print(f"[Trace] export failed: {e}")
+
+    async def _flush(self):
+        traces, self._pending = self._pending, []
+        if not traces:
+            return
+        if self.file_path:
+            lines = "".join(json.dumps(self._to_dict(t)) + "\n" for t in traces)
+            await asyncio.to_thread(self._append, lines)
+        if self.otlp_endpoint and self._client:
+            resp = await self._client.post(self.otlp_endpoint, json=self._to_otlp(traces))
+            resp.raise_for_status()
+
+    def _append(self, lines: str):
+        with open(self.file_path, "a") as f:
+            f.write(lines)
+
+    def _to_dict(self, trace: Trace) -> dict:
+        return {
+            "trace_id": trace.trace_id,
+            "name": trace.root.name,
+            "start_ns": trace.root.start_ns,
+            "duration_ms": round(trace.root.duration_ms, 3),
+            "attrs": trace.root.attrs,
+            "spans": [
+                {"name": s.name, "span_id": s.span_id, "parent_id": s.parent_id,
+                 "offset_ms": round((s.start_ns - trace.root.start_ns) / 1e6, 3),
+                 "duration_ms": round(s.duration_ms, 3), "attrs": s.attrs}
+                for s in trace.spans
+            ],
+        }
+
+    def _to_otlp(self, traces: list[Trace]) -> dict:
+        def attrs(d: dict) -> list[dict]:
+            return [{"key": k, "value": {"stringValue": str(v)}} for k, v in d.items()]
+
+        spans = []
+        for trace in traces:
+            for s in [trace.root] + trace.spans:
+                span = {
+                    "traceId": trace.trace_id,
+                    "spanId": s.span_id,
+                    "name": s.name,
+                    "kind": 1,
+                    "startTimeUnixNano": str(s.start_ns),
+                    "endTimeUnixNano": str(s.end_ns),
+                    "attributes": attrs(s.attrs),
+                }
+                if s.parent_id:
+                    span["parentSpanId"] = s.parent_id
+                spans.append(span)
+        return {"resourceSpans": [{
+            "resource": {"attributes": attrs({"service.name": self.service_name})},
+            "scopeSpans": [{"scope": {"name": self.service_name}, "spans": spans}],
+        }]}
+
+tracer = Tracer()
+
+def start_trace(name: str, **attrs) -> Trace | None:
+    """ new root trace, active in the current context. None (no-op) when tracing is off """
+    if not tracer.enabled:
+        return None
+    trace = Trace(name, random.random() < tracer.sample_rate, attrs)
+    _trace.set(trace)
+    _parent.set(trace.root.span_id)
+    return trace
+
+def current() -> Trace | None:
+    return _trace.get()
+
+def end_trace(trace: Trace | None, **attrs):
+    if trace is None or trace.root.end_ns:
+        return
+    trace.root.end_ns = time.time_ns()
+    trace.root.attrs.update(attrs)
+    if _trace.get() is trace:
+        _trace.set(None)
+        _parent.set(None)
+    tracer.finish(trace)
+
+@contextlib.contextmanager
+def span(name: str, **attrs):
+    trace = _trace.get()
+    if trace is None:
+        yield None
+        return
+    s = Span(name, _parent.get(), attrs)
+    token = _parent.set(s.span_id)
+    try:
+        yield s
+    except BaseException as e:
+        s.attrs["error"] = repr(e)
+        raise
+    finally:
+        s.end_ns = time.time_ns()
+        _parent.reset(token)
+        trace.spans.append(s)
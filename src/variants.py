@@ -0,0 +1,99 @@
+import io
+import os
+
+# /content/{uuid}?w=&h=&fmt= derivatives
+# requested w / h snap up to the next preset, so a file has a bounded number of derivatives
+SIZES = (64, 128, 256, 512, 768, 1024, 1536, 2048)
+MAX_DIMENSION = SIZES[-1]
+FORMATS = {
+    'webp': 'image/webp',
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+}
+QUALITY = 82
+
+def snap(v: int) -> int:
+    return next((size for size in SIZES if size >= v), MAX_DIMENSION)
+
+def parse_params(w: str | None, h: str | None, fmt: str | None) -> tuple[int | None, int | None, str] | None:
+    """ query -> (w, h, fmt) with w / h snapped to SIZES. raises ValueError if invalid, None if no derivative was asked for """
+    if w is None and h is None and fmt is None:
+        return None
+    width = int(w) if w else None
+    height = int(h) if h else None
+    for v in (width, height):
+        if v is not None and v <= 0:
+            raise ValueError(f"dimension out of range: {v}")
+    width = snap(width) if width else None
+    height = snap(height) if height else None
+    fmt = (fmt or 'webp').lower()
+    if fmt == 'jpg':
+        fmt = 'jpeg'
+    if fmt not in FORMATS:
+        raise ValueError(f"unsupported format: {fmt}")
+    return width, height, fmt
+
+def params_key(width: int | None, height: int | None, fmt: str) -> str:
+    # stable id of a derivative; also variants.params in the db
+    return f"w{width or 0}h{height or 0}.{fmt}"
+
+def cache_path(variant_dir: str, file_uuid: str, key: str) -> str:
+    # shard on the random tail: the head of a uuid7 is its timestamp
+    return os.path.join(variant_dir, file_uuid[-2:], f"{file_uuid}_{key}")
+
+def render(src_path: str, width: int | None, height: int | None, fmt: str) -> tuple[bytes, int, int]:
+    """
+    cpu-bound; runs in the process pool (gets a path, not the bytes). fit inside (width, height)
+    keeping the aspect ratio, never upscale. -> (encoded bytes, width, height)
+    """
+    from PIL import Image
+
+    with Image.open(src_path) as img:
+        img.seek(0) # animated -> first frame
+        img = img.copy()
+    img.thumbnail((width or img.width, height or img.height), Image.Resampling.LANCZOS)
+
+    if fmt == 'jpeg' and img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    elif img.mode == 'P':
+        img = img.convert('RGBA')
+
+    out = io.BytesIO()
+    if fmt == 'png':
+        img.save(out, format='PNG', optimize=True)
+    else:
+        img.save(out, format=fmt.upper(), quality=QUALITY)
+    return out.getvalue(), img.width, img.height
+
+def evict(variant_dir: str, max_bytes: int) -> tuple[int, int]:
+    """
+    blocking; LRU by mtime (served derivatives get touched) down to 90% of max_bytes.
+    in-progress files (.part / .src) are left alone. -> (files removed, bytes freed)
+    """
+    entries, total = [], 0
+    for root, _, names in os.walk(variant_dir):
+        for name in names:
+            if name.endswith(('.part', '.src')):
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+    if total <= max_bytes:
+        return 0, 0
+
+    entries.sort()
+    removed, freed = 0, 0
+    for _, size, path in entries:
+        if total - freed <= max_bytes * 0.9:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        removed += 1
+        freed += size
+    return removed, freed
@@ -1,6 +1,8 @@
 import asyncio
+import time
 import aiomysql
 from . import db
+from . import tracing
 
 class DBWorker:
     def __init__(self):
@@ -19,17 +21,23 @@ class DBWorker:
                     self.queue.task_done()
                     continue
                 # 2: run querry (offload...?)
+                trace = tracing.start_trace("db_worker", backlog=self.queue.qsize())
+                if trace and 'enqueued_ns' in task_data:
+                    trace.record("queued", task_data['enqueued_ns'], time.time_ns())
                 try:
                     async with db.pool.acquire() as conn:
                         async with conn.cursor() as cursor:
                             query = task_data.get('query')
                             params = task_data.get('params', ())
                             
-                            await cursor.execute(query, params)
-                            await conn.commit()
+                            with tracing.span("execute", query=query.split('(')[0].strip()):
+                                await cursor.execute(query, params)
+                                await conn.commit()
                             
                 except Exception as e:
                     print(f"[DBWorker] err while processing querry: {e} / data: {task_data}")
+                finally:
+                    tracing.end_trace(trace)
 
             except asyncio.CancelledError:
                 print("[DBWorker] closing...")
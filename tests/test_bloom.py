@@ -0,0 +1,47 @@
+import asyncio
+import time
+import uuid
+
+from uuid_extensions import uuid7
+
+from src import Controller, db
+from src.bloom import BloomFilter
+
+DAY_NS = 86400 * 1_000_000_000
+
+
+def make_controller() -> Controller.Con:
+    # redis / http are never touched by _screen
+    ctr = Controller.Con(sbots=[], db_queue=asyncio.Queue(), http_client=None)
+    ctr._bloom = BloomFilter(1000)
+    ctr._bloom_ready = True
+    return ctr
+
+
+def test_bloom_membership():
+    f = BloomFilter(1000)
+    keys = [uuid7(as_type='bytes') for _ in range(100)]
+    for k in keys:
+        f.add(k)
+    assert all(k in f for k in keys)
+    assert f.count == 100
+
+
+def test_uuid7_floor_orders_real_uuid7s():
+    now = time.time_ns()
+    floor = db.uuid7_floor(now - DAY_NS)
+    assert uuid7(as_type='bytes') >= floor
+    assert uuid7(ns=now - 2 * DAY_NS, as_type='bytes') < floor
+    assert uuid7(ns=now - DAY_NS + 1_000_000_000, as_type='bytes') >= floor
+
+
+def test_screen_bypasses_only_recent_uuids():
+    ctr = make_controller()
+    recent = str(uuid7())
+    old = uuid7(ns=time.time_ns() - 2 * DAY_NS)
+
+    assert ctr._screen(recent) == uuid.UUID(recent)
+    assert ctr._screen(str(old)) is None
+    ctr._bloom.add(old.bytes)
+    assert ctr._screen(str(old)) == old
+    assert ctr._screen("not-a-uuid") is None
@@ -0,0 +1,50 @@
+import asyncio
+import collections
+
+from src import Controller, SendTgbot, db
+
+JOB_SECONDS = 0.02
+
+
+async def run_dispatch(n_bots: int, seconds: float, monkeypatch) -> tuple[int, collections.Counter]:
+    """ real Con / Tgbot dispatch with claim + upload stubbed out -> (jobs done, claim limits) """
+    monkeypatch.setattr(db, 'pool', object())
+    bots = [SendTgbot.Tgbot(bot_id=i, token=f"t{i}", chat_ids=[-100]) for i in range(n_bots)]
+    for b in bots:
+        b.peers = [p for p in bots if p is not b]
+    ctr = Controller.Con(sbots=bots, db_queue=asyncio.Queue(), http_client=None)
+    done, limits = [0], collections.Counter()
+
+    async def claim(limit=None):
+        limits[limit] += 1
+        return [{'file_uuid': bytes(16)} for _ in range(limit)]
+
+    async def process(self, job):
+        self.in_flight += 1
+        try:
+            await asyncio.sleep(JOB_SECONDS)
+            done[0] += 1
+        finally:
+            self.in_flight -= 1
+            self.on_job_done(self)
+
+    bots[0]._fetch_and_claim_jobs = claim
+    monkeypatch.setattr(SendTgbot.Tgbot, '_process_job', process)
+    tasks = [asyncio.create_task(b._queue_worker()) for b in bots] + [asyncio.create_task(ctr.dispatch_task())]
+    await asyncio.sleep(seconds)
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return done[0], limits
+
+
+def test_bots_stay_busy_without_new_uploads(monkeypatch):
+    # DISPATCH_IDLE is 5 s: anything close to the ideal means bots refill on job completion
+    done, _ = asyncio.run(run_dispatch(3, 1.0, monkeypatch))
+    assert done >= 0.8 * 3 * (1.0 / JOB_SECONDS)
+
+
+def test_claims_are_whole_batches(monkeypatch):
+    # small claims would turn the weighted / per-lane split into FIFO
+    _, limits = asyncio.run(run_dispatch(1, 0.5, monkeypatch))
+    assert set(limits) == {SendTgbot.Tgbot(bot_id=0, token="t", chat_ids=[-100]).batch_size}
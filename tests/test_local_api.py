@@ -0,0 +1,256 @@
+import asyncio
+import hashlib
+import io
+import socket
+import threading
+import time
+import uuid
+
+import httpx
+import pytest
+import uvicorn
+from fastapi.testclient import TestClient
+from PIL import Image
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+from src import Controller, SendTgbot, db, index_cli, main
+from src.api import create_app
+
+TOKEN = "123:abc"
+
+
+class FakeBotApi:
+    """
+    telegram-bot-api stand-in: getMe / getFile / sendDocument / forwardMessage / deleteMessage
+    and file downloads. records what it was sent
+    """
+
+    def __init__(self):
+        self.local = False
+        self.calls: list[tuple[str, dict]] = []
+        # forwardMessage source: (chat_id, message_id) -> (caption, file bytes)
+        self.messages: dict[tuple[int, int], tuple[str, bytes]] = {}
+        self.app = Starlette(routes=[
+            Route("/bot{token}/{method}", self.handle, methods=["GET", "POST"]),
+            Route("/file/bot{token}/{path:path}", self.download),
+        ])
+
+    async def download(self, request):
+        self.calls.append(("download", {"path": request.path_params["path"]}))
+        _, data = self.messages[tuple(int(x) for x in request.path_params["path"].split("_"))]
+        return Response(data)
+
+    async def handle(self, request):
+        method = request.path_params["method"]
+        params = dict(request.query_params)
+        if request.method == "POST":
+            params.update(await request.form())
+        self.calls.append((method, params))
+        if method == "getMe":
+            result = {"id": 123, "is_bot": True, "first_name": "cdn", "username": "cdn_bot"}
+        elif method == "getFile":
+            file_path = "documents/file_0.png"
+            if params["file_id"].startswith("fwd:"):
+                file_path = params["file_id"][4:]
+            if self.local:
+                file_path = f"/var/lib/telegram-bot-api/{request.path_params['token']}/{file_path}"
+            result = {"file_id": params["file_id"], "file_unique_id": "u0", "file_path": file_path}
+        elif method == "sendDocument":
+            result = {
+                "message_id": 7,
+                "date": int(time.time()),
+                "chat": {"id": int(params["chat_id"]), "type": "channel"},
+                "document": {"file_id": "doc-7", "file_unique_id": "u7"},
+            }
+        elif method == "forwardMessage":
+            key = (int(params["from_chat_id"]), int(params["message_id"]))
+            if key not in self.messages:
+                return JSONResponse({"ok": False, "error_code": 400, "description": "Bad Request: message to forward not found"},
+                                    status_code=400)
+            caption, data = self.messages[key]
+            result = {
+                "message_id": 1000 + key[1],
+                "date": int(time.time()),
+                "chat": {"id": int(params["chat_id"]), "type": "supergroup"},
+                "caption": caption,
+                "document": {"file_id": f"fwd:{key[0]}_{key[1]}", "file_unique_id": f"u{key[1]}",
+                             "file_size": len(data), "mime_type": "image/png"},
+            }
+        elif method == "deleteMessage":
+            result = True
+        else:
+            return JSONResponse({"ok": False, "error_code": 404, "description": "Not Found"}, status_code=404)
+        return JSONResponse({"ok": True, "result": result})
+
+
+@pytest.fixture(scope="module")
+def bot_api():
+    fake = FakeBotApi()
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(fake.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 10
+    while not server.started:
+        assert thread.is_alive() and time.monotonic() < deadline, "fake bot api did not start"
+        time.sleep(0.01)
+    fake.base = f"http://127.0.0.1:{port}"
+    yield fake
+    server.should_exit = True
+    thread.join(timeout=10)
+
+
+@pytest.fixture(autouse=True)
+def reset(bot_api):
+    bot_api.local = False
+    bot_api.calls.clear()
+    bot_api.messages.clear()
+
+
+def make_controller(base: str, local: bool) -> Controller.Con:
+    # redis / db are never touched here
+    return Controller.Con(sbots=[], db_queue=asyncio.Queue(), http_client=httpx.AsyncClient(),
+                          api_url=base, api_local=local)
+
+
+def test_get_file_url_uses_base_url(bot_api):
+    async def run():
+        ctr = make_controller(bot_api.base, local=False)
+        try:
+            return await ctr._get_telegram_file_url(TOKEN, "f1")
+        finally:
+            await ctr._http_client.aclose()
+
+    assert asyncio.run(run()) == f"{bot_api.base}/file/bot{TOKEN}/documents/file_0.png"
+    assert bot_api.calls == [("getFile", {"file_id": "f1"})]
+
+
+def test_get_file_url_local_mode_returns_path(bot_api):
+    bot_api.local = True
+
+    async def run():
+        ctr = make_controller(bot_api.base, local=True)
+        try:
+            return await ctr._get_telegram_file_url(TOKEN, "f1")
+        finally:
+            await ctr._http_client.aclose()
+
+    path = asyncio.run(run())
+    assert path == f"/var/lib/telegram-bot-api/{TOKEN}/documents/file_0.png"
+    assert Controller.Con.is_local(path)
+
+
+def test_content_served_from_local_file(bot_api, tmp_path):
+    data = b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 8
+    path = tmp_path / "file_0.png"
+    path.write_bytes(data)
+    meta = {"size": len(data), "mime": "image/png", "sha256": "ab" * 32, "parts": 1}
+
+    ctr = make_controller(bot_api.base, local=True)
+
+    async def get_cache(file_uuid):
+        return str(path), meta
+
+    ctr.get_cache = get_cache
+    app = create_app()
+    app.state.controller = ctr
+    with TestClient(app) as client:
+        file_uuid = str(uuid.uuid4())
+        r = client.get(f"/content/{file_uuid}")
+        assert r.status_code == 200
+        assert r.content == data
+        assert r.headers["content-type"] == "image/png"
+        assert r.headers["etag"] == f'"{meta["sha256"]}"'
+
+        r = client.get(f"/content/{file_uuid}", headers={"Range": "bytes=8-15"})
+        assert r.status_code == 206
+        assert r.content == data[8:16]
+
+        path.unlink()
+        assert client.get(f"/content/{file_uuid}").status_code == 502
+    # nothing went upstream
+    assert bot_api.calls == []
+
+
+def _send(bot_api, tmp_path, local_mode: bool):
+    path = tmp_path / "upload.bin"
+    path.write_bytes(b"x" * 1024)
+
+    async def run():
+        tg = SendTgbot.Tgbot(bot_id=1, token=TOKEN, chat_ids=[-100], api_url=bot_api.base, local_mode=local_mode)
+        app = tg.build()
+        await app.bot.initialize()
+        try:
+            return await tg._send_file(str(path), "caption")
+        finally:
+            await app.bot.shutdown()
+
+    return path, asyncio.run(run())
+
+
+def test_local_mode_uploads_by_path(bot_api, tmp_path):
+    path, result = _send(bot_api, tmp_path, local_mode=True)
+    assert result == (7, "doc-7", -100)
+    method, params = bot_api.calls[-1]
+    assert method == "sendDocument"
+    assert params["document"] == path.absolute().as_uri()
+
+
+def test_cloud_mode_uploads_the_bytes(bot_api, tmp_path):
+    _, result = _send(bot_api, tmp_path, local_mode=False)
+    assert result == (7, "doc-7", -100)
+    method, params = bot_api.calls[-1]
+    assert method == "sendDocument"
+    assert not isinstance(params["document"], str)
+
+
+def test_backfill_uses_the_configured_server(bot_api, monkeypatch):
+    buf = io.BytesIO()
+    Image.new('RGB', (30, 20)).save(buf, 'PNG')
+    png = buf.getvalue()
+    file_uuid, big_uuid = uuid.uuid4(), uuid.uuid4()
+    bot_api.messages = {
+        (-100, 1): (str(file_uuid), png),
+        (-100, 2): (f"{big_uuid} 1/2", png[:40]),
+        (-200, 1): (f"{big_uuid} 2/2", png[40:]),
+    }
+
+    async def get_or_create_bot(token):
+        return {"bot_id": 1, "bot_token": token}
+
+    inserted = {}
+
+    async def insert_rows(cursor, table, cols, rows):
+        inserted.setdefault(table, []).extend(dict(zip(cols, row)) for row in rows)
+
+    class Pool:
+        def acquire(self):
+            return self
+
+        def cursor(self):
+            return self
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc):
+            return False
+
+        async def commit(self):
+            pass
+
+    monkeypatch.setattr(main, 'get_or_create_bot', get_or_create_bot)
+    monkeypatch.setattr(index_cli, '_insert_rows', insert_rows)
+    monkeypatch.setattr(db, 'pool', Pool())
+    asyncio.run(index_cli.backfill([TOKEN], [-100, -200], -9, 1, None, 2, api_url=bot_api.base))
+
+    files = {row["file_uuid"]: row for row in inserted["files"]}
+    single, big = files[file_uuid.bytes], files[big_uuid.bytes]
+    assert (single["sha256"], single["width"], single["height"]) == (hashlib.sha256(png).digest(), 30, 20)
+    assert (big["sha256"], big["file_size"], big["part_count"]) == (hashlib.sha256(png).digest(), len(png), 2)
+    assert [(p["part_no"], p["chat_id"]) for p in inserted["parts"]] == [(0, -100), (1, -200)]
+    assert ("download", {"path": "-100_1"}) in bot_api.calls
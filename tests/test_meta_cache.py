@@ -0,0 +1,45 @@
+import asyncio
+
+from src import Controller
+
+Con = Controller.Con
+
+
+def test_meta_round_trip_fits_a_listpack_value():
+    meta = {'size': 123456, 'mime': 'image/png', 'sha256': 'ab' * 32, 'width': 300, 'height': 200, 'parts': 1}
+    value = Con._pack_meta(meta)
+    assert len(value) <= 64
+    assert Con._unpack_meta(value) == meta
+
+
+def test_meta_unknown_fields_and_raw_mime():
+    meta = {'size': None, 'mime': 'video/mp4', 'sha256': None, 'width': None, 'height': None, 'parts': 3}
+    assert Con._unpack_meta(Con._pack_meta(meta)) == meta
+    assert Con._unpack_meta(None) is None
+
+
+class RecordingPipe:
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda *args: self.calls.append((name, *args))
+
+
+def test_meta_shares_the_url_buckets(monkeypatch):
+    monkeypatch.setattr(Controller.time, 'time', lambda: 5 * Con.META_SLICE + 10)
+    ctr = Con(sbots=[], db_queue=asyncio.Queue(), http_client=None)
+    slot = ctr._url_slot("0190a1b2-c3d4-7e5f-8a9b-0c1d2e3f4a5b")
+    assert slot == ('a5b', '0190a1b2c3d47e5f8a9b0c1d2e3f4')
+
+    pipe = RecordingPipe()
+    ctr._queue_meta_write(pipe, slot, {'size': 1, 'mime': 'image/gif', 'parts': 1})
+    ctr._queue_meta_read(pipe, slot)
+    value = pipe.calls[0][3]
+    assert pipe.calls == [
+        ('hset', 'tgc:m:5:a5b', slot[1], value),
+        ('expireat', 'tgc:m:5:a5b', 7 * Con.META_SLICE),
+        ('hget', 'tgc:m:5:a5b', slot[1]),
+        ('hget', 'tgc:m:4:a5b', slot[1]),
+    ]
+    assert ctr._take_meta(None, value)['mime'] == 'image/gif'
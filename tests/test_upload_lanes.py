@@ -0,0 +1,82 @@
+import io
+import ipaddress
+
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+from src import api, db
+from src.api import create_app
+
+
+class RecordingPool:
+    """ db.pool stand-in: records queue inserts, reports `waiting` interactive jobs per lane """
+
+    def __init__(self, waiting: int = 0):
+        self.waiting = waiting
+        self.inserts: list[tuple] = []
+
+    def acquire(self):
+        return self
+
+    def cursor(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, sql, params=()):
+        if "INSERT INTO queues" in sql:
+            self.inserts.append(params)
+
+    async def fetchone(self):
+        return (self.waiting,)
+
+    @property
+    def lastrowid(self):
+        return len(self.inserts)
+
+
+def png() -> bytes:
+    buf = io.BytesIO()
+    Image.new('RGB', (4, 4)).save(buf, 'PNG')
+    return buf.getvalue()
+
+
+@pytest.fixture
+def upload(tmp_path, monkeypatch):
+    monkeypatch.setattr(api, 'TEMP_DIR', str(tmp_path))
+    monkeypatch.setattr(api, 'TRUSTED_PROXIES', [ipaddress.ip_network("10.0.0.0/8")])
+    pool = RecordingPool()
+    monkeypatch.setattr(db, 'pool', pool)
+    app = create_app()
+    app.state.controller = None
+
+    def send(peer: str, headers: dict | None = None) -> tuple:
+        client = TestClient(app, client=(peer, 50000))
+        r = client.post("/upload", files={'file': ('a.png', png(), 'image/png')}, headers=headers or {})
+        assert r.status_code == 200
+        *_, priority, lane = pool.inserts[-1]
+        return priority, lane
+
+    send.pool = pool
+    return send
+
+
+def test_lane_is_the_peer_address(upload):
+    assert upload("203.0.113.7", {'X-Client-Id': 'spoofed'}) == (db.PRIORITY_INTERACTIVE, "203.0.113.7")
+    assert upload("2001:db8:1:2:3:4:5:6")[1] == "2001:db8:1:2::/64"
+
+
+def test_client_id_only_from_trusted_proxies(upload):
+    assert upload("10.1.2.3", {'X-Client-Id': 'user-42'})[1] == "user-42"
+    assert upload("10.1.2.3")[1] == "10.1.2.3"
+
+
+def test_flooding_lane_is_demoted_to_bulk(upload):
+    upload.pool.waiting = api.INTERACTIVE_LANE_MAX
+    assert upload("203.0.113.7")[0] == db.PRIORITY_BULK
+    assert upload("203.0.113.7", {'X-Upload-Priority': 'bulk'})[0] == db.PRIORITY_BULK
@@ -0,0 +1,130 @@
+import io
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+from src import api, db, variants
+from src.api import create_app
+
+
+class StubController:
+    """ just enough of Controller.Con for a local-mode derivative build """
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.meta = {'size': size, 'mime': 'image/png', 'sha256': 'ab' * 32, 'width': 300, 'height': 200, 'parts': 1}
+
+    async def get_meta(self, file_uuid):
+        return self.meta
+
+    async def get_cache(self, file_uuid):
+        return self.path, self.meta
+
+    @staticmethod
+    def is_local(url):
+        return url.startswith('/')
+
+
+class EmptyPool:
+    """ db.pool stand-in: no indexed derivatives """
+
+    def acquire(self):
+        return self
+
+    def cursor(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, *args):
+        pass
+
+    async def fetchone(self):
+        return None
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    src = tmp_path / "orig.png"
+    Image.new('RGB', (300, 200), 'red').save(src)
+    monkeypatch.setattr(api, 'VARIANT_DIR', str(tmp_path / "variants"))
+    monkeypatch.setattr(db, 'pool', EmptyPool())
+    app = create_app()
+    app.state.controller = StubController(str(src), src.stat().st_size)
+    app.state.variant_pool = ThreadPoolExecutor(1)
+    with TestClient(app) as c:
+        yield c
+    app.state.variant_pool.shutdown()
+
+
+def test_parse_params_snaps_to_presets():
+    assert variants.parse_params('100', None, None) == (128, None, 'webp')
+    assert variants.parse_params('1', '9999', 'jpg') == (64, variants.MAX_DIMENSION, 'jpeg')
+    with pytest.raises(ValueError):
+        variants.parse_params('0', None, None)
+    with pytest.raises(ValueError):
+        variants.parse_params('64', None, 'gif')
+
+
+def test_evict_drops_least_recently_served(tmp_path):
+    now = time.time()
+    for i, name in enumerate(['old', 'mid', 'new']):
+        path = tmp_path / name
+        path.write_bytes(b'x' * 100)
+        os.utime(path, (now + i, now + i))
+    (tmp_path / "x.src").write_bytes(b'x' * 1000)
+
+    assert variants.evict(str(tmp_path), 1000) == (0, 0)
+    assert variants.evict(str(tmp_path), 250) == (1, 100)
+    assert sorted(os.listdir(tmp_path)) == ['mid', 'new', 'x.src']
+
+
+def test_variant_build_and_conditional_get(client):
+    file_uuid = str(uuid.uuid4())
+    r = client.get(f"/content/{file_uuid}?w=100&fmt=png")
+    assert r.status_code == 200
+    assert r.headers['content-type'] == 'image/png'
+    etag = r.headers['etag']
+    assert etag.endswith('-w128h0.png"')
+
+    r = client.get(f"/content/{file_uuid}?w=100&fmt=png", headers={'If-None-Match': f'W/{etag}'})
+    assert r.status_code == 304
+    # no staged originals left behind
+    assert not any(n.endswith('.src') for _, _, names in os.walk(api.VARIANT_DIR) for n in names)
+
+
+def test_cache_path_shards_on_the_random_tail():
+    path = variants.cache_path("/v", "0190a1b2-c3d4-7e5f-8a9b-0c1d2e3f4a5b", "w64h0.webp")
+    assert path == "/v/5b/0190a1b2-c3d4-7e5f-8a9b-0c1d2e3f4a5b_w64h0.webp"
+
+
+def test_variant_refuses_large_sources(client, monkeypatch):
+    monkeypatch.setattr(api, 'VARIANT_MAX_SOURCE_BYTES', 10)
+    r = client.get(f"/content/{uuid.uuid4()}?w=64")
+    assert r.status_code == 413
+
+
+def test_variant_streams_remote_original(client):
+    ctr = client.app.state.controller
+    with open(ctr.path, 'rb') as f:
+        body = f.read()
+
+    async def open_upstream(file_uuid, url):
+        return httpx.Response(200, stream=httpx.ByteStream(body), request=httpx.Request("GET", url))
+
+    ctr.path = "https://api.telegram.org/file/bot0/photos/orig.png"
+    ctr.open_upstream = open_upstream
+    ctr.read_size = 64
+    r = client.get(f"/content/{uuid.uuid4()}?w=64&h=64&fmt=jpeg")
+    assert r.status_code == 200
+    assert Image.open(io.BytesIO(r.content)).size == (64, 43)